@@ -1,3 +1,33 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Document, Extraction, LayoutTemplate, OcrLine, Page
+
+
+class PageInline(admin.TabularInline):
+    model = Page
+    extra = 0
+
+
+class ExtractionInline(admin.StackedInline):
+    model = Extraction
+    extra = 0
+
+
+@admin.register(Document)
+class DocumentAdmin(admin.ModelAdmin):
+    list_display = ("id", "original_name", "created_at")
+    search_fields = ("original_name", "image_path")
+    inlines = [PageInline, ExtractionInline]
+
+
+@admin.register(OcrLine)
+class OcrLineAdmin(admin.ModelAdmin):
+    list_display = ("id", "page", "index", "text", "confidence")
+    list_select_related = ("page__document",)
+    raw_id_fields = ("page",)
+
+
+@admin.register(LayoutTemplate)
+class LayoutTemplateAdmin(admin.ModelAdmin):
+    list_display = ("id", "sample_count", "match_count", "updated_at")
+    readonly_fields = ("task_key", "created_at", "updated_at")
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DocumentProcessorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'document_processor'
+
+    def ready(self):
+        from document_processor import signals  # noqa: F401
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+
+from document_processor.services.pipeline import get_pipeline, process_documents
+
+# The same text for every document in a batch; per-document details go in the
+# document part of the prompt
+DEFAULT_TASK = """
+Please process the document using OCR
+and extract the following information in JSON format:
+- total_amount_of_the_invoice (just the number, e.g. 123.45)
+- currency (if detectable, e.g. USD, EUR)
+- invoice_number (if present)
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Run document images through the extraction pipeline, overlapping "
+        "OCR of one document with the LLM call of another."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("image_paths", nargs="+")
+        parser.add_argument("--prompt", default=DEFAULT_TASK)
+        parser.add_argument("--model", default="claude-3-haiku-20240307")
+        parser.add_argument("--temperature", type=float, default=0.2)
+
+    def handle(self, *args, **options):
+        results = process_documents(
+            options["image_paths"],
+            task_description=options["prompt"],
+            model_name=options["model"],
+            temperature=options["temperature"],
+        )
+
+        for result in results:
+            ocr_output = result["ocr_output"]
+            self.stdout.write("\n" + "─" * 35 + f" {result['image_path']} " + "─" * 20)
+            self.stdout.write(ocr_output[:800] + "..." if len(ocr_output) > 800 else ocr_output)
+            self.stdout.write("\n" + "─" * 35 + " EXTRACTION RESULT " + "─" * 28)
+            self.stdout.write(result["llm_output"])
+            self.stdout.write(f"Source: {result['source']}, tokens: {result.get('usage')}")
+
+        stats = get_pipeline().stats()
+        self.stdout.write("\n" + "─" * 35 + " PIPELINE STATS " + "─" * 33)
+        for stage in stats["stages"]:
+            self.stdout.write(
+                f"{stage['stage']:>15}: {stage['processed']} docs, "
+                f"{stage['avg_seconds']}s avg, utilization {stage['utilization']:.0%}"
+            )
+        self.stdout.write(f"Bottleneck: {stats['bottleneck']}")
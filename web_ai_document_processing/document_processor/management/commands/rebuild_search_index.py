@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from document_processor.models import Document
+from document_processor.services import search
+
+
+class Command(BaseCommand):
+    help = "Recreate the full-text search index from the stored documents."
+
+    def handle(self, *args, **options):
+        if not search.fts_enabled():
+            self.stdout.write("Full-text search needs SQLite FTS5; nothing to rebuild.")
+            return
+
+        search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {Document.objects.count()} documents."
+        ))
@@ -0,0 +1,39 @@
+from django.db import migrations
+
+
+CREATE_SEARCH_INDEX = """
+CREATE VIRTUAL TABLE IF NOT EXISTS document_processor_search USING fts5(
+    text,
+    document_id UNINDEXED,
+    page_number UNINDEXED,
+    line_id UNINDEXED,
+    kind UNINDEXED,
+    field_name UNINDEXED,
+    tokenize = 'unicode61',
+    prefix = '2 3'
+)
+"""
+
+DROP_SEARCH_INDEX = "DROP TABLE IF EXISTS document_processor_search"
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite-only; other backends fall back to ORM lookups.
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(CREATE_SEARCH_INDEX)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(DROP_SEARCH_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("document_processor", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('document_processor', '0002_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayoutTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_key', models.CharField(db_index=True, max_length=64)),
+                ('anchors', models.JSONField(default=list)),
+                ('field_regions', models.JSONField(default=dict)),
+                ('unstable_fields', models.JSONField(blank=True, default=list)),
+                ('sample_count', models.PositiveIntegerField(default=1)),
+                ('match_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='extraction',
+            name='confidence',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='extraction',
+            name='source',
+            field=models.CharField(choices=[('llm', 'LLM agent'), ('template', 'Layout template')], default='llm', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='extraction',
+            name='template',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='extractions', to='document_processor.layouttemplate'),
+        ),
+    ]
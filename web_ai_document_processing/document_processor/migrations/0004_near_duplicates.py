@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('document_processor', '0003_layout_templates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='image_hash',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='numbers_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='text_signature',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AlterField(
+            model_name='extraction',
+            name='source',
+            field=models.CharField(choices=[('llm', 'LLM agent'), ('template', 'Layout template'), ('duplicate', 'Near-duplicate reuse')], default='llm', max_length=20),
+        ),
+    ]
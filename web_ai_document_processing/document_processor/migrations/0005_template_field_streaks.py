@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('document_processor', '0004_near_duplicates'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='layouttemplate',
+            name='unstable_fields',
+        ),
+        migrations.AlterField(
+            model_name='layouttemplate',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
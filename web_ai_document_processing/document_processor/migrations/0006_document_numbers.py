@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:38
+
+import re
+
+from django.db import migrations, models
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+_SEPARATOR = re.compile(r"[.,]")
+
+
+def backfill_numbers(apps, schema_editor):
+    # Same rules as duplicates.page_numbers, frozen at this migration
+    Document = apps.get_model("document_processor", "Document")
+    OcrLine = apps.get_model("document_processor", "OcrLine")
+
+    for document in Document.objects.only("pk").iterator(chunk_size=200):
+        text = "\n".join(
+            OcrLine.objects.filter(page__document=document)
+            .order_by("page__number", "index")
+            .values_list("text", flat=True)
+        )
+        numbers = []
+        for raw in _NUMBER.findall(text):
+            number = _SEPARATOR.sub("", raw).lstrip("0") or "0"
+            if len(number) >= 3 or _SEPARATOR.search(raw):
+                numbers.append(number)
+        Document.objects.filter(pk=document.pk).update(numbers=sorted(numbers))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('document_processor', '0005_template_field_streaks'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='document',
+            name='numbers_hash',
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='numbers',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(backfill_numbers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('document_processor', '0006_document_numbers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layouttemplate',
+            name='expected_fields',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
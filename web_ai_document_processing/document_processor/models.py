@@ -1,3 +1,124 @@
 from django.db import models
 
-# Create your models here.
+
+class Document(models.Model):
+    """
+    An uploaded document image that went through the pipeline.
+    """
+    image_path = models.CharField(max_length=500)
+    original_name = models.CharField(max_length=255, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    image_hash = models.CharField(max_length=16, blank=True)
+    numbers = models.JSONField(default=list, blank=True)
+    text_signature = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return self.original_name or self.image_path
+
+
+class Page(models.Model):
+    """
+    A single page of a document. Images produce exactly one page.
+    """
+    document = models.ForeignKey(
+        Document, related_name="pages", on_delete=models.CASCADE
+    )
+    number = models.PositiveIntegerField(default=1)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["document", "number"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["document", "number"], name="unique_page_number"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.document} p.{self.number}"
+
+
+class OcrLine(models.Model):
+    """
+    One recognized text line with its bounding box and confidence.
+    """
+    page = models.ForeignKey(Page, related_name="lines", on_delete=models.CASCADE)
+    index = models.PositiveIntegerField()
+    text = models.TextField()
+    x_min = models.FloatField(null=True, blank=True)
+    y_min = models.FloatField(null=True, blank=True)
+    x_max = models.FloatField(null=True, blank=True)
+    y_max = models.FloatField(null=True, blank=True)
+    confidence = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["page", "index"]
+
+    @property
+    def bbox(self):
+        if self.x_min is None:
+            return None
+        return [self.x_min, self.y_min, self.x_max, self.y_max]
+
+    def __str__(self):
+        return self.text
+
+
+class Extraction(models.Model):
+    """
+    The LLM result for a document and the task it was asked to perform.
+    """
+    document = models.ForeignKey(
+        Document, related_name="extractions", on_delete=models.CASCADE
+    )
+    task_description = models.TextField(blank=True)
+    llm_output = models.TextField(blank=True)
+    fields = models.JSONField(default=dict, blank=True)
+    model_name = models.CharField(max_length=100, blank=True)
+    source = models.CharField(
+        max_length=20,
+        choices=[
+            ("llm", "LLM agent"),
+            ("template", "Layout template"),
+            ("duplicate", "Near-duplicate reuse"),
+        ],
+        default="llm",
+    )
+    template = models.ForeignKey(
+        "LayoutTemplate",
+        related_name="extractions",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    confidence = models.FloatField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"Extraction for {self.document}"
+
+
+class LayoutTemplate(models.Model):
+    """
+    A learned page layout (e.g. one vendor's invoice) and where each
+    extracted field sits on it. Coordinates are normalized to 0..1.
+    """
+    task_key = models.CharField(max_length=64, db_index=True)
+    anchors = models.JSONField(default=list)
+    field_regions = models.JSONField(default=dict)
+    expected_fields = models.JSONField(default=list, blank=True)
+    sample_count = models.PositiveIntegerField(default=1)
+    match_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f"Template #{self.pk} ({len(self.field_regions)} fields)"
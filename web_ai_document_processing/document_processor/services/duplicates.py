@@ -0,0 +1,326 @@
+import hashlib
+import random
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from django.conf import settings
+from PIL import Image
+
+from document_processor.models import Document, Extraction
+
+# Defaults, overridable from Django settings
+CANDIDATE_DISTANCE = 12     # Hamming distance worth confirming with OCR text
+TEXT_SIMILARITY = 0.9       # estimated shingle Jaccard needed to confirm a duplicate
+NUMBER_SIMILARITY = 1.0     # Jaccard of the amounts and IDs on both pages
+
+HASH_SIZE = 8               # 8x8 gradient bits -> 64-bit hash
+SHINGLE_SIZE = 3            # words per shingle
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16              # 16 bands x 4 rows of the MinHash signature
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1729)  # fixed seed: signatures must be stable across processes
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+_SEPARATOR = re.compile(r"[.,]")
+_WORD = re.compile(r"\w+")
+
+
+def _setting(name: str, default):
+    return getattr(settings, f"DUPLICATE_{name}", default)
+
+
+def content_hash(image_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_hash(image: Union[str, Image.Image]) -> str:
+    """
+    Difference hash (dHash) of an image path or an already decoded image:
+    robust to re-compression, re-scaling and small brightness changes.
+    Returned as 16 hex chars.
+    """
+    if isinstance(image, Image.Image):
+        small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    else:
+        with Image.open(image) as opened:
+            # Let JPEG decode at reduced scale; we only need a thumbnail
+            opened.draft("L", (HASH_SIZE * 16, HASH_SIZE * 16))
+            small = opened.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(small.getdata())
+
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+
+    return f"{bits:016x}"
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def text_signature(text: str) -> List[int]:
+    """
+    MinHash signature over word shingles of the OCR text. Punctuation is
+    dropped so OCR noise like "EUR." vs "EUR" doesn't break shingles.
+    """
+    words = _WORD.findall(text.lower())
+    if not words:
+        return []
+
+    shingles = {
+        " ".join(words[i:i + SHINGLE_SIZE])
+        for i in range(max(1, len(words) - SHINGLE_SIZE + 1))
+    }
+    hashes = [
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+        for s in shingles
+    ]
+
+    return [
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def normalize_number(raw: str) -> str:
+    """
+    Drop decimal and thousands separators, which OCR and locales disagree
+    on: "45.00" and "45,00" both become "4500", "1.234,56" and "1,234.56"
+    both "123456".
+    """
+    return _SEPARATOR.sub("", raw).lstrip("0") or "0"
+
+
+def page_numbers(text: str) -> List[str]:
+    """
+    The amounts and IDs on the page, normalized and sorted. Two invoices
+    from the same vendor share nearly all their text and layout, so these
+    are what tells them apart.
+
+    Short bare numbers (quantities, days, page numbers) are left out: they
+    rarely distinguish documents and are the ones OCR misreads most.
+    """
+    numbers = []
+    for raw in _NUMBER.findall(text):
+        number = normalize_number(raw)
+        if len(number) >= 3 or _SEPARATOR.search(raw):
+            numbers.append(number)
+    return sorted(numbers)
+
+
+def number_similarity(a: List[str], b: List[str]) -> float:
+    """
+    Multiset Jaccard similarity of two `page_numbers` lists.
+    """
+    if not a and not b:
+        return 1.0
+    ca, cb = Counter(a), Counter(b)
+    return sum((ca & cb).values()) / sum((ca | cb).values())
+
+
+def signature_similarity(a: List[int], b: List[int]) -> float:
+    if not a or len(a) != len(b):
+        return 0.0
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def _bands(signature: List[int]) -> List[Tuple[int, Tuple[int, ...]]]:
+    rows = len(signature) // LSH_BANDS
+    return [
+        (band, tuple(signature[band * rows:(band + 1) * rows]))
+        for band in range(LSH_BANDS)
+    ]
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes in Hamming space. A radius
+    query only descends into children whose edge distance can still hold
+    a match, so lookups touch a small part of the tree.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value: int, item: Any):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, Any]]:
+        if self.root is None:
+            return []
+
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((distance, item) for item in node[1])
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+
+        return sorted(found, key=lambda pair: pair[0])
+
+
+class NearDuplicateIndex:
+    """
+    BK-tree over image hashes plus MinHash LSH buckets over OCR text,
+    filled incrementally from stored documents.
+    """
+
+    def __init__(self):
+        self.tree = BKTree()
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+        self.last_pk = 0
+
+    def add(self, document_id: int, hash_hex: str, signature: List[int]):
+        if hash_hex:
+            self.tree.add(int(hash_hex, 16), document_id)
+        if signature:
+            for key in _bands(signature):
+                self.buckets.setdefault(key, []).append(document_id)
+        self.last_pk = max(self.last_pk, document_id)
+
+    def refresh(self):
+        rows = (
+            Document.objects.filter(pk__gt=self.last_pk)
+            .values_list("pk", "image_hash", "text_signature")
+            .order_by("pk")
+        )
+        for pk, hash_hex, signature in rows.iterator(chunk_size=2000):
+            self.add(pk, hash_hex, signature)
+
+    def image_candidates(self, hash_hex: str, radius: int) -> List[Tuple[int, int]]:
+        return self.tree.search(int(hash_hex, 16), radius)
+
+    def text_candidates(self, signature: List[int]) -> List[int]:
+        seen: Dict[int, None] = {}
+        for key in _bands(signature):
+            for document_id in self.buckets.get(key, ()):
+                seen[document_id] = None
+        return list(seen)
+
+
+_index = NearDuplicateIndex()
+_index_lock = threading.Lock()
+
+
+def get_index() -> NearDuplicateIndex:
+    with _index_lock:
+        _index.refresh()
+        return _index
+
+
+def find_exact(hash_hex: str) -> Optional[Document]:
+    """
+    Byte-identical re-upload: safe to reuse without running OCR at all.
+    """
+    if not hash_hex:
+        return None
+    return Document.objects.filter(content_hash=hash_hex).order_by("-pk").first()
+
+
+def image_candidates(hash_hex: str) -> List[int]:
+    if not hash_hex:
+        return []
+    radius = _setting("CANDIDATE_DISTANCE", CANDIDATE_DISTANCE)
+    return [pk for _, pk in get_index().image_candidates(hash_hex, radius)]
+
+
+def find_near_duplicate(
+    ocr_text: str,
+    candidate_ids: List[int],
+) -> Tuple[Optional[Document], float]:
+    """
+    Pick the stored document that matches this page's OCR text, among the
+    image-hash candidates and the text LSH buckets. The image hash alone is
+    not trusted: invoices sharing a vendor layout hash almost identically.
+    """
+    signature = text_signature(ocr_text)
+    if not signature:
+        return None, 0.0
+
+    ids = list(dict.fromkeys(candidate_ids + get_index().text_candidates(signature)))
+    if not ids:
+        return None, 0.0
+
+    numbers = page_numbers(ocr_text)
+    min_numbers = _setting("NUMBER_SIMILARITY", NUMBER_SIMILARITY)
+    candidates = Document.objects.filter(pk__in=ids).only(
+        "pk", "image_path", "text_signature", "numbers"
+    )
+
+    best, best_score = None, 0.0
+    for document in candidates:
+        if number_similarity(numbers, document.numbers) < min_numbers:
+            continue
+        score = signature_similarity(signature, document.text_signature)
+        if score > best_score:
+            best, best_score = document, score
+
+    if best_score < _setting("TEXT_SIMILARITY", TEXT_SIMILARITY):
+        return None, best_score
+    return best, best_score
+
+
+def stored_page_size(document: Document) -> Optional[Tuple[int, int]]:
+    page = document.pages.order_by("number").first()
+    if page is None or not page.width or not page.height:
+        return None
+    return page.width, page.height
+
+
+def stored_ocr_lines(document: Document) -> List[Dict[str, Any]]:
+    page = document.pages.order_by("number").first()
+    if page is None:
+        return []
+
+    lines = []
+    for line in page.lines.all():
+        item: Dict[str, Any] = {"text": line.text, "bbox": line.bbox}
+        if line.confidence is not None:
+            item["confidence"] = line.confidence
+        lines.append(item)
+    return lines
+
+
+def stored_extraction(document: Document, task_description: Optional[str]) -> Optional[Extraction]:
+    """
+    The most recent extraction of `document` made for the same request.
+    """
+    wanted = " ".join((task_description or "").lower().split())
+    for extraction in document.extractions.order_by("-created_at"):
+        if " ".join(extraction.task_description.lower().split()) == wanted:
+            return extraction
+    return None
@@ -0,0 +1,104 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from PIL import Image, UnidentifiedImageError
+
+# Hard cap on decoded image size. PIL warns above this and refuses at 2x,
+# which protects every Image.open() in the app against decompression bombs.
+MAX_IMAGE_PIXELS = getattr(settings, "MAX_IMAGE_PIXELS", 60_000_000)
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def image_size(image_path: str) -> Tuple[int, int]:
+    """
+    Width and height from the file header, without decoding pixels.
+    """
+    with Image.open(image_path) as image:
+        return image.size
+
+
+def check_pixel_limit(image_path: str) -> Optional[Tuple[int, int]]:
+    """
+    Reject images above MAX_IMAGE_PIXELS before anything decodes them.
+    Returns None for files PIL can't read (e.g. PDFs handled by the engine).
+    """
+    try:
+        width, height = image_size(image_path)
+    except Image.DecompressionBombError as exc:
+        raise ImageTooLarge(str(exc)) from exc
+    except UnidentifiedImageError:
+        return None
+
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(
+            f"Image is {width}x{height} ({width * height} pixels); "
+            f"the limit is {MAX_IMAGE_PIXELS} pixels"
+        )
+    return width, height
+
+
+def _target_size(size: Tuple[int, int], max_side: Optional[int]) -> Tuple[int, int]:
+    width, height = size
+    scale = min(1.0, max_side / max(width, height)) if max_side else 1.0
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def decode_image(image_path: str, max_side: Optional[int] = None) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    Decode to RGB, returning the image and the original size.
+
+    With `max_side`, JPEGs are decoded directly at a reduced scale (draft
+    mode), so the full resolution bitmap is never materialized; the result
+    may still be somewhat larger than `max_side`.
+    """
+    with Image.open(image_path) as image:
+        size = image.size
+        image.draft("RGB", _target_size(size, max_side))
+        return image.convert("RGB"), size
+
+
+def prepare_for_ocr(
+    image: Image.Image,
+    size: Tuple[int, int],
+    max_side: Optional[int] = None,
+) -> Tuple[np.ndarray, float]:
+    """
+    Resize a decoded page to at most `max_side` on the longest side and
+    return it as the BGR array OCR engines expect, plus the factor that
+    maps its coordinates back to the original `size`.
+    """
+    target = _target_size(size, max_side)
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS)
+
+    array = np.asarray(image)[:, :, ::-1].copy()
+    return array, size[0] / target[0]
+
+
+def load_for_ocr(image_path: str, max_side: int) -> Tuple[np.ndarray, float]:
+    """
+    `decode_image` followed by `prepare_for_ocr`.
+    """
+    image, size = decode_image(image_path, max_side)
+    return prepare_for_ocr(image, size, max_side)
+
+
+def crop_regions(
+    image_path: str,
+    boxes: List[Tuple[int, int, int, int]],
+) -> List[np.ndarray]:
+    """
+    BGR crops of `boxes` from the original image. Only the crops are
+    color-converted, not the whole page.
+    """
+    crops = []
+    with Image.open(image_path) as image:
+        for box in boxes:
+            crop = image.crop(box).convert("RGB")
+            crops.append(np.asarray(crop)[:, :, ::-1].copy())
+    return crops
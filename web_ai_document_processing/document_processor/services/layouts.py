@@ -0,0 +1,483 @@
+import hashlib
+import re
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from document_processor.models import Extraction, LayoutTemplate
+
+# Defaults, overridable from Django settings
+MATCH_THRESHOLD = 0.6        # anchor similarity needed to call it the same layout
+CONFIDENCE_THRESHOLD = 0.8   # min OCR confidence of every field read from a template
+MIN_SAMPLES = 2              # consecutive LLM runs that must agree on a field's region
+ANCHOR_TOLERANCE = 0.03      # max centre distance (page fraction) for an anchor match
+REGION_IOU = 0.3             # min overlap between an OCR line and a field region
+STABLE_IOU = 0.5             # min overlap for two samples of a field to agree
+SINGLETON_DAYS = 7           # keep single-sample templates this long for a second sample
+REFRESH_SECONDS = 30         # how often to pick up templates learned by other processes
+
+PRUNE_INTERVAL = 3600
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+
+
+def _setting(name: str, default):
+    return getattr(settings, f"LAYOUT_TEMPLATE_{name}", default)
+
+
+def task_key(task_description: Optional[str]) -> str:
+    """
+    Templates are only valid for the request they were learned from.
+    """
+    normalized = " ".join((task_description or "").lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _normalize_text(text: str) -> str:
+    return _NON_ALNUM.sub("", text.lower())
+
+
+def _normalized_boxes(
+    ocr_lines: List[Dict[str, Any]],
+    page_size: Optional[Tuple[int, int]],
+) -> List[Tuple[str, List[float], Optional[float]]]:
+    """
+    Return (text, bbox in 0..1 page coordinates, confidence) for every
+    OCR line that has a bounding box.
+    """
+    lines = [item for item in ocr_lines if item.get("text") and item.get("bbox")]
+    if not lines:
+        return []
+
+    if page_size:
+        width, height = page_size
+    else:
+        width = max(float(item["bbox"][2]) for item in lines)
+        height = max(float(item["bbox"][3]) for item in lines)
+    width, height = max(float(width), 1.0), max(float(height), 1.0)
+
+    return [
+        (
+            item["text"],
+            [
+                float(item["bbox"][0]) / width,
+                float(item["bbox"][1]) / height,
+                float(item["bbox"][2]) / width,
+                float(item["bbox"][3]) / height,
+            ],
+            item.get("confidence"),
+        )
+        for item in lines
+    ]
+
+
+def _iou(a: List[float], b: List[float]) -> float:
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x1 - x0) * max(0.0, y1 - y0)
+    if inter == 0.0:
+        return 0.0
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def fingerprint(
+    ocr_lines: List[Dict[str, Any]],
+    page_size: Optional[Tuple[int, int]] = None,
+) -> List[List[Any]]:
+    """
+    Describe a page layout by its static labels and their positions.
+
+    Lines containing digits are skipped: those are the per-document values
+    (amounts, dates, numbers), while headings like "Invoice" or "Bill To"
+    repeat on every document from the same vendor.
+    """
+    anchors = []
+
+    for text, bbox, _ in _normalized_boxes(ocr_lines, page_size):
+        if any(ch.isdigit() for ch in text):
+            continue
+
+        key = _normalize_text(text)
+        if len(key) < 3:
+            continue
+
+        cx = round((bbox[0] + bbox[2]) / 2, 4)
+        cy = round((bbox[1] + bbox[3]) / 2, 4)
+        anchors.append([key, cx, cy])
+
+    return anchors
+
+
+def similarity(a: List[List[Any]], b: List[List[Any]]) -> float:
+    """
+    Jaccard similarity of two anchor sets, where anchors match when they
+    have the same text and nearly the same position.
+    """
+    if not a or not b:
+        return 0.0
+
+    tolerance = _setting("ANCHOR_TOLERANCE", ANCHOR_TOLERANCE)
+    by_text: Dict[str, List[List[Any]]] = {}
+    for anchor in b:
+        by_text.setdefault(anchor[0], []).append(anchor)
+
+    matched = 0
+    for text, cx, cy in a:
+        for candidate in by_text.get(text, ()):
+            if abs(candidate[1] - cx) <= tolerance and abs(candidate[2] - cy) <= tolerance:
+                matched += 1
+                break
+
+    return matched / (len(a) + len(b) - matched)
+
+
+class TemplateIndex:
+    """
+    In-memory inverted index from anchor text to templates, so a page is
+    only compared against templates that share some of its labels.
+
+    Updated in place: this process's own writes go in through `put`, other
+    processes' writes through a periodic `refresh` of recently changed rows.
+    """
+
+    def __init__(self):
+        self.templates: Dict[int, LayoutTemplate] = {}
+        self.postings: Dict[Tuple[str, str], set] = {}
+        self.synced_at = None
+        self.checked_at = 0.0
+        self.lock = threading.RLock()
+
+    def put(self, template: LayoutTemplate):
+        with self.lock:
+            self.remove(template.pk)
+            self.templates[template.pk] = template
+            for text in {anchor[0] for anchor in template.anchors}:
+                self.postings.setdefault((template.task_key, text), set()).add(template.pk)
+
+    def remove(self, pk: int):
+        with self.lock:
+            template = self.templates.pop(pk, None)
+            if template is None:
+                return
+            for text in {anchor[0] for anchor in template.anchors}:
+                self.postings.get((template.task_key, text), set()).discard(pk)
+
+    def refresh(self):
+        """
+        Load templates created or changed since the last refresh.
+        """
+        started = timezone.now()
+        templates = LayoutTemplate.objects.all()
+        if self.synced_at is not None:
+            templates = templates.filter(updated_at__gte=self.synced_at)
+
+        for template in templates.iterator(chunk_size=500):
+            self.put(template)
+        self.synced_at = started
+        self.checked_at = time.monotonic()
+
+    def best_match(
+        self, anchors: List[List[Any]], key: str
+    ) -> Tuple[Optional[LayoutTemplate], float]:
+        with self.lock:
+            votes: Dict[int, int] = {}
+            for text in {anchor[0] for anchor in anchors}:
+                for pk in self.postings.get((key, text), ()):
+                    votes[pk] = votes.get(pk, 0) + 1
+
+            # Only score the strongest candidates
+            candidates = [
+                self.templates[pk]
+                for pk in sorted(votes, key=votes.get, reverse=True)[:10]
+            ]
+
+        best, best_score = None, 0.0
+        for template in candidates:
+            score = similarity(anchors, template.anchors)
+            if score > best_score:
+                best, best_score = template, score
+
+        return best, best_score
+
+
+_index = TemplateIndex()
+_index_lock = threading.Lock()
+
+
+def get_index() -> TemplateIndex:
+    """
+    Return the shared index, picking up other processes' template changes
+    at most every REFRESH_SECONDS.
+    """
+    with _index_lock:
+        interval = _setting("REFRESH_SECONDS", REFRESH_SECONDS)
+        if _index.synced_at is None or time.monotonic() - _index.checked_at >= interval:
+            _index.refresh()
+        return _index
+
+
+def stable_regions(template: LayoutTemplate) -> Dict[str, Dict[str, Any]]:
+    """
+    Field regions that enough consecutive LLM samples agreed on.
+    """
+    min_samples = _setting("MIN_SAMPLES", MIN_SAMPLES)
+    return {
+        name: region
+        for name, region in template.field_regions.items()
+        if region.get("streak", 1) >= min_samples
+    }
+
+
+def readable_regions(template: LayoutTemplate) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    The stable regions, provided they cover every field the LLM has
+    returned for this template; otherwise None, and the LLM must answer.
+    """
+    regions = stable_regions(template)
+    expected = template.expected_fields
+    if not expected or any(name not in regions for name in expected):
+        return None
+    return {name: regions[name] for name in expected}
+
+
+def _is_trusted(template: LayoutTemplate) -> bool:
+    return readable_regions(template) is not None
+
+
+def _read_region(
+    lines: List[Tuple[str, List[float], Optional[float]]],
+    region: Dict[str, Any],
+) -> Tuple[Optional[str], float]:
+    best_line, best_iou = None, _setting("REGION_IOU", REGION_IOU)
+    for line in lines:
+        overlap = _iou(line[1], region["bbox"])
+        if overlap >= best_iou:
+            best_line, best_iou = line, overlap
+
+    if best_line is None:
+        return None, 0.0
+
+    text = best_line[0].strip()
+    prefix, suffix = region.get("prefix", ""), region.get("suffix", "")
+    if prefix and text.lower().startswith(prefix.lower()):
+        text = text[len(prefix):]
+    if suffix and text.lower().endswith(suffix.lower()):
+        text = text[:-len(suffix)]
+
+    confidence = best_line[2] if best_line[2] is not None else 1.0
+    return text.strip(" :"), float(confidence)
+
+
+def extract_with_template(
+    ocr_lines: List[Dict[str, Any]],
+    page_size: Optional[Tuple[int, int]] = None,
+    task_description: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Read the fields straight from OCR output when the page matches a trusted
+    template. Returns None when the LLM should handle the document.
+    """
+    anchors = fingerprint(ocr_lines, page_size)
+    if not anchors:
+        return None
+
+    template, score = get_index().best_match(anchors, task_key(task_description))
+    if template is None or score < _setting("MATCH_THRESHOLD", MATCH_THRESHOLD):
+        return None
+    regions = readable_regions(template)
+    if regions is None:
+        return None
+
+    lines = _normalized_boxes(ocr_lines, page_size)
+    fields: Dict[str, str] = {}
+    confidence = 1.0
+
+    for name, region in regions.items():
+        value, field_confidence = _read_region(lines, region)
+        if not value:
+            return None
+        fields[name] = value
+        confidence = min(confidence, field_confidence)
+
+    if confidence < _setting("CONFIDENCE_THRESHOLD", CONFIDENCE_THRESHOLD):
+        return None
+
+    LayoutTemplate.objects.filter(pk=template.pk).update(match_count=F("match_count") + 1)
+
+    return {
+        "template": template,
+        "fields": fields,
+        "score": score,
+        "confidence": confidence,
+    }
+
+
+def _locate_field(
+    lines: List[Tuple[str, List[float], Optional[float]]],
+    value: Any,
+) -> Optional[Dict[str, Any]]:
+    """
+    Find the OCR line holding an extracted value and remember any label
+    text around it, e.g. "Total:" in "Total: 45.00".
+
+    Returns None unless reading the region back from this same page gives
+    exactly the LLM's value. Reformatted values (a JSON 1234.5 read from
+    "Total: $1,234.50") and non-string values can't be reproduced from the
+    page text, so they stay with the LLM.
+    """
+    if not isinstance(value, str) or not value.strip():
+        return None
+    value = value.strip()
+
+    target = _normalize_text(value)
+    matches = [line for line in lines if target and target in _normalize_text(line[0])]
+    if not matches:
+        return None
+
+    # The shortest containing line is the most specific one
+    text, bbox, _ = min(matches, key=lambda line: len(line[0]))
+    position = text.lower().find(value.lower())
+    if position == -1:
+        return None
+
+    region = {
+        "bbox": [round(v, 4) for v in bbox],
+        "prefix": text[:position].strip(),
+        "suffix": text[position + len(value):].strip(),
+    }
+    read, _ = _read_region(lines, region)
+    if read != value:
+        return None
+    return region
+
+
+def _merge_region(known: Optional[Dict[str, Any]], region: Dict[str, Any]) -> Dict[str, Any]:
+    if known is None or _iou(known["bbox"], region["bbox"]) < _setting("STABLE_IOU", STABLE_IOU):
+        # New or moved field: start counting agreeing samples again
+        return dict(region, streak=1)
+
+    return {
+        "bbox": [round((a + b) / 2, 4) for a, b in zip(known["bbox"], region["bbox"])],
+        "prefix": known.get("prefix", ""),
+        "suffix": known.get("suffix", ""),
+        "streak": known.get("streak", 1) + 1,
+    }
+
+
+_pruned_at: Optional[float] = None
+
+
+def prune_singletons():
+    """
+    Delete templates that never saw a second sample. Most LLM documents are
+    one-offs, so without this the table would grow with every upload.
+    """
+    global _pruned_at
+
+    now = time.monotonic()
+    if _pruned_at is not None and now - _pruned_at < PRUNE_INTERVAL:
+        return
+    _pruned_at = now
+
+    cutoff = timezone.now() - timedelta(days=_setting("SINGLETON_DAYS", SINGLETON_DAYS))
+    stale = list(
+        LayoutTemplate.objects.filter(sample_count=1, updated_at__lt=cutoff)
+        .values_list("pk", flat=True)
+    )
+    if stale:
+        LayoutTemplate.objects.filter(pk__in=stale, sample_count=1).delete()
+        for pk in stale:
+            _index.remove(pk)
+
+
+def learn_template(
+    ocr_lines: List[Dict[str, Any]],
+    fields: Dict[str, Any],
+    page_size: Optional[Tuple[int, int]] = None,
+    task_description: Optional[str] = None,
+) -> Optional[LayoutTemplate]:
+    """
+    Record where an LLM extraction found its fields, creating a new template
+    or reinforcing the matching one.
+
+    Every field the LLM returned is recorded as expected; only those found
+    on the page get a region. A template answers only when all expected
+    fields have stable regions, so inferred values (e.g. a currency that
+    isn't printed) keep the layout with the LLM instead of being dropped.
+    """
+    anchors = fingerprint(ocr_lines, page_size)
+    if not anchors:
+        return None
+
+    lines = _normalized_boxes(ocr_lines, page_size)
+    regions = {}
+    for name, value in (fields or {}).items():
+        region = _locate_field(lines, value)
+        if region is not None:
+            regions[name] = region
+    if not regions:
+        return None
+
+    key = task_key(task_description)
+    index = get_index()
+    match, score = index.best_match(anchors, key)
+    prune_singletons()
+
+    template = None
+    if match is not None and score >= _setting("MATCH_THRESHOLD", MATCH_THRESHOLD):
+        # Several LLM workers learn concurrently; lock the row while merging
+        with transaction.atomic():
+            template = LayoutTemplate.objects.select_for_update().filter(pk=match.pk).first()
+            if template is not None:
+                merged = dict(template.field_regions)
+                for name, region in regions.items():
+                    merged[name] = _merge_region(merged.get(name), region)
+                template.field_regions = merged
+                template.expected_fields = sorted(set(template.expected_fields) | set(fields))
+                template.sample_count += 1
+                template.save(update_fields=[
+                    "field_regions", "expected_fields", "sample_count", "updated_at",
+                ])
+        if template is None:
+            index.remove(match.pk)
+
+    if template is None:
+        template = LayoutTemplate.objects.create(
+            task_key=key,
+            anchors=anchors,
+            field_regions={name: dict(region, streak=1) for name, region in regions.items()},
+            expected_fields=sorted(fields),
+        )
+
+    index.put(template)
+    return template
+
+
+def template_stats() -> Dict[str, Any]:
+    """
+    How often templates and duplicate reuse let us skip the LLM.
+    """
+    counts = dict(
+        Extraction.objects.values_list("source").annotate(n=Count("id")).order_by()
+    )
+    total = sum(counts.values())
+    llm = counts.get("llm", 0)
+
+    return {
+        "total": total,
+        "template": counts.get("template", 0),
+        "duplicate": counts.get("duplicate", 0),
+        "llm": llm,
+        "skip_rate": (total - llm) / total if total else 0.0,
+        "templates": LayoutTemplate.objects.count(),
+        "trusted_templates": sum(
+            1 for template in LayoutTemplate.objects.all() if _is_trusted(template)
+        ),
+    }
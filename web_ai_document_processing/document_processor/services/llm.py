@@ -1,7 +1,12 @@
-from typing import Dict, Optional, Any
+import json
+from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
 from langchain_anthropic import ChatAnthropic
+from langchain_anthropic.chat_models import convert_to_anthropic_tool
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_classic.agents import AgentExecutor, create_tool_calling_agent
 
@@ -9,16 +14,176 @@ from document_processor.services import ocr as tools
 
 load_dotenv()
 
+SYSTEM_PROMPT = (
+    "You are a document extraction assistant. "
+    "When the OCR text of the document is provided, answer from it directly. "
+    "Otherwise use the OCR tool on the given image path. "
+    "Return only the requested fields."
+)
+
+# Anthropic prompt caching: the request prefix up to a marked block is cached
+# and re-read at a fraction of the cost. Prefix order is tools -> system ->
+# messages, so the stable parts (tool schema, system prompt, field
+# instructions) come first and the per-document text last.
+#
+# Prefixes shorter than the model's minimum are silently not cached, so a
+# block is only marked once the prefix up to it can reach that minimum.
+# With today's short SYSTEM_PROMPT nothing qualifies; caching starts paying
+# off once the static instructions grow (e.g. field definitions, examples).
+CACHE_CONTROL = {"type": "ephemeral"}
+
+MIN_CACHEABLE_TOKENS = {
+    "claude-3-haiku": 2048,
+    "claude-3-5-haiku": 2048,
+    "claude-haiku-4-5": 4096,
+    "claude-opus-4-5": 4096,
+}
+DEFAULT_MIN_CACHEABLE_TOKENS = 1024
+CHARS_PER_TOKEN = 4  # rough estimate for English prompts and JSON schemas
+
+
+def min_cacheable_tokens(model_name: str) -> int:
+    for prefix, minimum in MIN_CACHEABLE_TOKENS.items():
+        if model_name.startswith(prefix):
+            return minimum
+    return DEFAULT_MIN_CACHEABLE_TOKENS
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def plan_cache_breakpoints(
+    model_name: str,
+    tools_list: List[Any],
+    system_prompt: str,
+    instruction: str = "",
+) -> Dict[str, bool]:
+    """
+    Which of the static prompt parts (tools, system, instruction) end a
+    prefix long enough for the model to cache.
+    """
+    minimum = min_cacheable_tokens(model_name)
+    schemas = [convert_to_anthropic_tool(tool) for tool in tools_list]
+
+    tokens = estimate_tokens(json.dumps(schemas, default=str))
+    plan = {"tools": bool(schemas) and tokens >= minimum}
+    tokens += estimate_tokens(system_prompt)
+    plan["system"] = tokens >= minimum
+    tokens += estimate_tokens(instruction)
+    plan["instruction"] = bool(instruction) and tokens >= minimum
+    return plan
+
+
+def cached_tool_schemas(tools_list: List[Any], cache: bool = True) -> List[Dict[str, Any]]:
+    """
+    Anthropic tool definitions, with a cache breakpoint after the last one
+    when `cache` is set.
+    """
+    schemas = [dict(convert_to_anthropic_tool(tool)) for tool in tools_list]
+    if schemas and cache:
+        schemas[-1]["cache_control"] = CACHE_CONTROL
+    return schemas
+
 
-def run_ocr_extraction(image_path: str) -> str:
+def _text_block(text: str, cache: bool) -> Dict[str, Any]:
+    block: Dict[str, Any] = {"type": "text", "text": text}
+    if cache:
+        block["cache_control"] = CACHE_CONTROL
+    return block
+
+
+def build_user_message(instruction: str, document: str, cache: bool = False) -> HumanMessage:
+    """
+    The request's field instructions first, marked for caching when `cache`
+    is set (see plan_cache_breakpoints), then the document-specific part
+    (path, OCR text) which changes on every call.
+    """
+    return HumanMessage(content=[
+        _text_block(f"User request:\n{instruction}", cache),
+        {"type": "text", "text": document},
+    ])
+
+
+class UsageCallback(BaseCallbackHandler):
     """
-    Extract plain text from an image using the configured OCR backend.
+    Sums token usage, including prompt cache reads and writes, over every
+    model call an agent run makes.
     """
-    try:
-        results = tools.ocr_read_document.invoke(image_path)
-        return "\n".join(item["text"] for item in results if "text" in item)
-    except Exception as exc:
-        return f"OCR extraction failed: {exc}"
+
+    def __init__(self):
+        self.usage = {
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+        }
+
+    def on_llm_end(self, response, **kwargs: Any):
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None)
+                if not usage:
+                    continue
+                details = usage.get("input_token_details") or {}
+                self.usage["input_tokens"] += usage.get("input_tokens") or 0
+                self.usage["output_tokens"] += usage.get("output_tokens") or 0
+                self.usage["cache_read_input_tokens"] += details.get("cache_read") or 0
+                self.usage["cache_creation_input_tokens"] += details.get("cache_creation") or 0
+
+
+def build_extraction_agent(
+    tools_list: List[Any],
+    system_prompt: str,
+    model_name: str = "claude-3-haiku-20240307",
+    temperature: float = 0.3,
+    max_tokens: int = 800,
+    verbose: bool = False,
+    llm: Optional[BaseChatModel] = None,
+    breakpoints: Optional[Dict[str, bool]] = None,
+) -> AgentExecutor:
+    """
+    Anthropic tool-calling agent used for document extraction, with the
+    tool schema and system prompt marked for prompt caching where
+    `breakpoints` (default: plan_cache_breakpoints) allows.
+
+    Invoke it with {"messages": [build_user_message(...)]}.
+    """
+    if breakpoints is None:
+        breakpoints = plan_cache_breakpoints(model_name, tools_list, system_prompt)
+
+    if llm is None:
+        llm = ChatAnthropic(
+            model=model_name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+    prompt = ChatPromptTemplate.from_messages([
+        SystemMessage(content=[_text_block(system_prompt, breakpoints["system"])]),
+        MessagesPlaceholder(variable_name="messages"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ])
+
+    # The model sees the cache-marked schemas; the executor runs the real tools
+    agent = create_tool_calling_agent(
+        llm=llm,
+        tools=cached_tool_schemas(tools_list, cache=breakpoints["tools"]),
+        prompt=prompt,
+    )
+
+    return AgentExecutor(
+        agent=agent,
+        tools=tools_list,
+        handle_parsing_errors=True,
+        max_iterations=6,
+        verbose=verbose,
+    )
+
+
+def ocr_lines_to_text(results: List[Dict[str, Any]]) -> str:
+    return "\n".join(item["text"] for item in results if "text" in item)
 
 
 def normalize_llm_output(output: Any) -> str:
@@ -42,60 +207,38 @@ def run_llm_document_extraction(
     task_description: Optional[str] = None,
     model_name: str = "claude-3-haiku-20240307",
     temperature: float = 0.3,
-) -> Dict[str, str]:
+    document_text: Optional[str] = None,
+) -> Dict[str, Any]:
     """
-    Run OCR + LLM agent to extract structured information from a document image.
+    Ask the LLM agent for the requested fields of one document.
+
+    `document_text` is the prompt's per-document part, normally the path
+    plus compacted OCR text (see pipeline.compact_stage). Without it the
+    agent only gets the path and runs the OCR tool itself.
     """
     instruction = task_description or "Extract all relevant information."
-
-    llm = ChatAnthropic(
-        model=model_name,
-        temperature=temperature,
-        max_tokens=800,
-    )
+    if document_text is None:
+        document_text = f"Document path:\n{image_path}\n"
 
     tools_list = [tools.ocr_read_document]
-
-    system_prompt = (
-        "You are a document extraction assistant. "
-        "Always use the OCR tool when given an image path. "
-        "Return only the requested fields."
-    )
-
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        ("user", "{input}"),
-        MessagesPlaceholder(variable_name="agent_scratchpad"),
-    ])
-
-    agent = create_tool_calling_agent(
-        llm=llm,
-        tools=tools_list,
-        prompt=prompt,
+    breakpoints = plan_cache_breakpoints(model_name, tools_list, SYSTEM_PROMPT, instruction)
+    agent_executor = build_extraction_agent(
+        tools_list=tools_list,
+        system_prompt=SYSTEM_PROMPT,
+        model_name=model_name,
+        temperature=temperature,
+        breakpoints=breakpoints,
     )
 
-    agent_executor = AgentExecutor(
-        agent=agent,
-        tools=tools_list,
-        handle_parsing_errors=True,
-        max_iterations=6,
-        verbose=False,
+    usage = UsageCallback()
+    message = build_user_message(instruction, document_text, cache=breakpoints["instruction"])
+    response = agent_executor.invoke(
+        {"messages": [message]},
+        config={"callbacks": [usage]},
     )
 
-    task = f"""
-Document path:
-{image_path}
-
-User request:
-{instruction}
-"""
-
-    response = agent_executor.invoke({"input": task})
-    llm_result = normalize_llm_output(response.get("output", ""))
-
     return {
-        "success": True,
-        "ocr_output": run_ocr_extraction(image_path),
-        "llm_output": llm_result,
-        "image_path": image_path,
+        "llm_output": normalize_llm_output(response.get("output", "")),
+        "model_name": model_name,
+        "usage": usage.usage,
     }
\ No newline at end of file
@@ -0,0 +1,210 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Rough peak bytes per input pixel across decoding, the OCR engine's
+# resized copies and feature maps; calibrate with the memory profile.
+BYTES_PER_PIXEL = 24
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    pass
+
+
+def estimate_request_bytes(size: Optional[Tuple[int, int]]) -> int:
+    """
+    Expected peak memory for processing an image of `size` (None if unknown).
+    """
+    if size is None:
+        return getattr(settings, "MEMORY_DEFAULT_REQUEST_BYTES", 256 * 1024 ** 2)
+    width, height = size
+    return width * height * getattr(settings, "MEMORY_BYTES_PER_PIXEL", BYTES_PER_PIXEL)
+
+
+class Reservation:
+    """
+    Memory taken from a MemoryBudget; `release` is safe to call repeatedly.
+    """
+
+    def __init__(self, budget: "MemoryBudget", amount: int):
+        self.budget = budget
+        self.amount = amount
+        self.released = False
+
+    def release(self):
+        with self.budget.condition:
+            if self.released:
+                return
+            self.released = True
+            self.budget.in_use -= self.amount
+            self.budget.condition.notify_all()
+
+
+class MemoryBudget:
+    """
+    Per-process admission control: a document reserves its estimated peak
+    memory before it is decoded and waits while the budget is used up.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount: int, timeout: Optional[float] = None) -> Reservation:
+        # A single oversized request still runs, but alone
+        amount = min(amount, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.condition:
+            while self.in_use + amount > self.capacity:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise MemoryBudgetExceeded(
+                        f"Timed out waiting for {amount} bytes of memory budget"
+                    )
+                self.condition.wait(remaining)
+            self.in_use += amount
+
+        return Reservation(self, amount)
+
+    @contextmanager
+    def reserve(self, amount: int, timeout: Optional[float] = None):
+        reservation = self.acquire(amount, timeout)
+        try:
+            yield reservation.amount
+        finally:
+            reservation.release()
+
+
+_budget: Optional[MemoryBudget] = None
+_budget_lock = threading.Lock()
+
+
+def get_memory_budget() -> MemoryBudget:
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = MemoryBudget(getattr(settings, "MEMORY_BUDGET_BYTES", 2 * 1024 ** 3))
+        return _budget
+
+
+def current_rss() -> Optional[int]:
+    # Linux only; elsewhere only the process-lifetime peak is available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss() -> Optional[int]:
+    if resource is None:
+        return None
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+_tracing_users = 0
+_tracing_owned = False
+_tracing_lock = threading.Lock()
+
+
+class RssSampler(threading.Thread):
+    """
+    Polls the process RSS in the background and keeps the highest value,
+    giving the peak of one time window rather than of the process lifetime.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def stop(self) -> Optional[int]:
+        self._stop_event.set()
+        self.join()
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+        return self.peak
+
+
+class MemoryProfile:
+    """
+    Opt-in tracemalloc + RSS report around one request.
+
+    tracemalloc is process-wide, so concurrent requests show up in each
+    other's Python numbers; RSS also covers native allocations (PaddleOCR),
+    which tracemalloc cannot see, but it too is shared with whatever else
+    the process runs meanwhile. `rss_peak_bytes` is sampled during the
+    request; `process_peak_rss_bytes` is the peak since the process started.
+    """
+
+    def __init__(self, top: int = 5, interval: float = 0.05):
+        self.top = top
+        self.interval = interval
+        self.report: Dict[str, Any] = {}
+
+    def __enter__(self):
+        global _tracing_users, _tracing_owned
+        with _tracing_lock:
+            if _tracing_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing_owned = True
+            _tracing_users += 1
+        tracemalloc.reset_peak()
+
+        self.rss_before = current_rss()
+        self.sampler = RssSampler(self.interval)
+        self.sampler.start()
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _tracing_users, _tracing_owned
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        rss_peak = self.sampler.stop()
+        rss_after = current_rss()
+
+        with _tracing_lock:
+            _tracing_users -= 1
+            if _tracing_users == 0 and _tracing_owned:
+                tracemalloc.stop()
+                _tracing_owned = False
+
+        stats = snapshot.statistics("lineno")[:self.top]
+        self.report = {
+            "seconds": round(time.monotonic() - self.started, 3),
+            "python_current_bytes": current,
+            "python_peak_bytes": peak,
+            "rss_before_bytes": self.rss_before,
+            "rss_after_bytes": rss_after,
+            "rss_peak_bytes": rss_peak,
+            "process_peak_rss_bytes": peak_rss(),
+            "top_allocations": [
+                {"where": str(stat.traceback[0]), "bytes": stat.size, "count": stat.count}
+                for stat in stats
+            ],
+        }
+        return False
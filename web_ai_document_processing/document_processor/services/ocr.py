@@ -1,14 +1,19 @@
-from typing import Any, Dict, List
+import gc
+from typing import Any, Dict, List, Optional
 from django.conf import settings
 
-from paddleocr import PaddleOCR
+from paddleocr import PaddleOCR, TextRecognition
 from langchain.tools import tool
+import numpy as np
 from PIL import Image
 import pytesseract
 import requests
 
+from document_processor.services import images
+
 # Lazy initialization
 _paddle_ocr_instance = None
+_paddle_recognizer_instance = None
 
 
 def get_paddle_instance():
@@ -18,14 +23,57 @@ def get_paddle_instance():
     return _paddle_ocr_instance
 
 
-def extract_with_paddle(image_path: str) -> List[Dict[str, Any]]:
+def get_paddle_recognizer():
+    """
+    Recognition-only model for re-reading cropped lines (no detection pass).
+    """
+    global _paddle_recognizer_instance
+    if _paddle_recognizer_instance is None:
+        model_name = getattr(settings, "OCR_REFINE_MODEL", None)
+        _paddle_recognizer_instance = (
+            TextRecognition(model_name=model_name) if model_name else TextRecognition()
+        )
+    return _paddle_recognizer_instance
+
+
+def extract_with_paddle(
+    image_path: str,
+    image: Optional[np.ndarray] = None,
+    scale: float = 1.0,
+) -> List[Dict[str, Any]]:
+    """
+    OCR with PaddleOCR. Pass `image` (BGR array) when the page is already
+    decoded, with `scale` mapping its coordinates back to the original.
+
+    The page is read at OCR_DECODE_MAX_SIDE pixels, which is fast and keeps
+    memory bounded; lines that come out unsure are re-read from crops of
+    the full-resolution original by refine_low_confidence().
+    """
     ocr = get_paddle_instance()
-    result = ocr.predict(image_path)
+
+    # Large scans are decoded straight to a reduced size instead of letting
+    # the engine hold a full-resolution copy; boxes are scaled back below
+    if image is None:
+        image, scale = image_path, 1.0
+        size = images.check_pixel_limit(image_path)
+        max_side = getattr(settings, "OCR_DECODE_MAX_SIDE", 0)
+        if size and max_side and max(size) > max_side:
+            image, scale = images.load_for_ocr(image_path, max_side)
+
+    result = ocr.predict(image)
     page = result[0]
 
-    texts = page["rec_texts"]
-    boxes = page["dt_polys"]
-    scores = page.get("rec_scores", [None] * len(texts))
+    texts = list(page["rec_texts"])
+    boxes = [[(float(x) * scale, float(y) * scale) for x, y in box] for box in page["dt_polys"]]
+    scores = [
+        None if score is None else float(score)
+        for score in page.get("rec_scores", [None] * len(texts))
+    ]
+
+    # The result also holds the input and preprocessed page images; drop
+    # them now instead of at the end of the request
+    del result, page, image
+    gc.collect()
 
     extracted_items: List[Dict[str, Any]] = []
 
@@ -48,9 +96,72 @@ def extract_with_paddle(image_path: str) -> List[Dict[str, Any]]:
 
         extracted_items.append(item)
 
+    # Re-reading at the same resolution with the same model gains nothing,
+    # so only refine when the first pass was downscaled or a stronger
+    # recognizer is configured
+    threshold = getattr(settings, "OCR_REFINE_THRESHOLD", 0.0)
+    if threshold and (scale > 1.0 or getattr(settings, "OCR_REFINE_MODEL", None)):
+        refine_low_confidence(image_path, extracted_items, threshold)
+
     return extracted_items
 
 
+def refine_low_confidence(
+    image_path: str,
+    items: List[Dict[str, Any]],
+    threshold: float = 0.85,
+    padding: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Re-recognize lines scored below `threshold` from padded crops of the
+    original full-resolution image, in one batch, and keep the new text
+    where it scores higher. Updates `items` in place.
+    """
+    if padding is None:
+        padding = getattr(settings, "OCR_REFINE_PADDING", 4)
+
+    selected = [
+        item for item in items
+        if item.get("bbox") and item.get("confidence") is not None
+        and item["confidence"] < threshold
+    ]
+    if not selected:
+        return items
+
+    size = images.check_pixel_limit(image_path)
+    if size is None:
+        return items
+
+    width, height = size
+    boxes = []
+    for item in selected:
+        x_min, y_min, x_max, y_max = item["bbox"]
+        boxes.append((
+            max(0, int(x_min) - padding),
+            max(0, int(y_min) - padding),
+            min(width, int(x_max) + padding),
+            min(height, int(y_max) + padding),
+        ))
+
+    crops = images.crop_regions(image_path, boxes)
+    outputs = get_paddle_recognizer().predict(
+        input=crops,
+        batch_size=getattr(settings, "OCR_REFINE_BATCH_SIZE", 16),
+    )
+
+    for item, output in zip(selected, outputs):
+        text, score = output["rec_text"], output["rec_score"]
+        if text and score > item["confidence"]:
+            item["text"] = text
+            item["confidence"] = float(score)
+            item["refined"] = True
+
+    del crops, outputs
+    gc.collect()
+
+    return items
+
+
 def extract_with_tesseract(image_path: str) -> List[Dict[str, Any]]:
     text = pytesseract.image_to_string(Image.open(image_path))
 
@@ -104,6 +215,31 @@ def extract_with_api(image_path: str):
 
 
 
+def read_document(
+    image_path: str,
+    image: Optional[np.ndarray] = None,
+    scale: float = 1.0,
+) -> List[Dict[str, Any]]:
+    """
+    Run the OCR engine selected in Django settings. Only PaddleOCR uses a
+    pre-decoded `image`; the other engines read the file themselves.
+    """
+    engine = getattr(settings, "OCR_ENGINE", "paddle")
+
+    if engine == "tesseract":
+        print("Using Tesseract OCR backend...")
+        return extract_with_tesseract(image_path)
+    if engine == "api":
+        print("Using OCR API backend...")
+        return extract_with_api(image_path)
+
+    if engine == "paddle":
+        print("Using PaddleOCR backend...")
+        return extract_with_paddle(image_path, image, scale)
+    else:
+        raise ValueError(f"Unsupported OCR_ENGINE: {engine}")
+
+
 # 🔥 Unified OCR tool (THIS is what LLM uses)
 @tool
 def ocr_read_document(image_path: str) -> List[Dict[str, Any]]:
@@ -111,21 +247,7 @@ def ocr_read_document(image_path: str) -> List[Dict[str, Any]]:
     Unified OCR tool. Engine selected via Django settings.
     """
     try:
-        engine = getattr(settings, "OCR_ENGINE", "paddle")
-
-        if engine == "tesseract":
-            print("Using Tesseract OCR backend...")
-            return extract_with_tesseract(image_path)
-        if engine == "api":
-            print("Using OCR API backend...")
-            return extract_with_api(image_path)           
-
-        if engine == "paddle":
-            print("Using PaddleOCR backend...")
-            return extract_with_paddle(image_path)
-        else:
-            raise ValueError(f"Unsupported OCR_ENGINE: {engine}")
-
+        return read_document(image_path)
     except Exception as exc:
         return [{"error": f"OCR failed: {exc}"}]
 
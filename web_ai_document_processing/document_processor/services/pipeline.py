@@ -0,0 +1,509 @@
+"""
+Staged document pipeline shared by the web service and the batch command
+(`manage.py process_documents`). Each stage has its own worker pool and a
+bounded input queue, so OCR of one document overlaps the LLM call of
+another while a slow stage applies back-pressure instead of piling up work
+in memory.
+"""
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from document_processor.services import duplicates, images, layouts, memory, storage
+from document_processor.services import ocr as tools
+from document_processor.services.llm import ocr_lines_to_text, run_llm_document_extraction
+
+_STOP = object()
+
+
+def compact_ocr_lines(ocr_lines: List[Dict[str, Any]]) -> str:
+    """
+    Render OCR output as one line per text box with a rounded position,
+    which is all the LLM needs and far fewer tokens than the raw dicts.
+    """
+    rows = []
+    for item in ocr_lines:
+        if "text" not in item:
+            continue
+        bbox = item.get("bbox")
+        if bbox:
+            rows.append(f"[{int(bbox[0])},{int(bbox[1])}] {item['text']}")
+        else:
+            rows.append(item["text"])
+    return "\n".join(rows)
+
+
+class Stage:
+    """
+    One pipeline step. `func` receives the job dict and updates it in place.
+    """
+
+    def __init__(self, name: str, func: Callable[[Dict[str, Any]], None], workers: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.stopped = 0
+
+    def record(self, busy: float, waited: float, ran: bool, failed: bool):
+        with self.lock:
+            self.busy_seconds += busy
+            self.wait_seconds += waited
+            if failed:
+                self.errors += 1
+            elif ran:
+                self.processed += 1
+            else:
+                self.skipped += 1
+
+
+class StagePipeline:
+    """
+    Run jobs through `stages` in order. A job is a dict; a stage can finish
+    it early by setting job["done"] = True, which makes later stages
+    (except those marked in `always_run`) pass it through untouched.
+
+    `cleanup`, if given, is called once with every job as it completes,
+    whether it succeeded, finished early or failed.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int = 8,
+        always_run: Iterable[str] = (),
+        cleanup: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+        self.always_run = set(always_run)
+        self.cleanup = cleanup
+        self.threads: List[threading.Thread] = []
+        self.started_at: Optional[float] = None
+        self._start_lock = threading.Lock()
+
+    def start(self) -> "StagePipeline":
+        with self._start_lock:
+            if self.started_at is not None:
+                return self
+            self.started_at = time.monotonic()
+
+            for position, stage in enumerate(self.stages):
+                for n in range(stage.workers):
+                    thread = threading.Thread(
+                        target=self._worker,
+                        args=(position,),
+                        name=f"pipeline-{stage.name}-{n}",
+                        daemon=True,
+                    )
+                    thread.start()
+                    self.threads.append(thread)
+        return self
+
+    def submit(self, job: Dict[str, Any]) -> Future:
+        """
+        Queue a job; blocks while the first stage's queue is full.
+        """
+        self.start()
+        future: Future = Future()
+        job.setdefault("done", False)
+        self.queues[0].put((job, future, time.monotonic()))
+        return future
+
+    def run(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        return self.submit(job).result()
+
+    def map(self, jobs: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Push a batch through the pipeline and return results in input order.
+        """
+        futures = [self.submit(job) for job in jobs]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """
+        Stop the workers after the queued jobs have drained.
+        """
+        if self.started_at is None:
+            return
+        for _ in range(self.stages[0].workers):
+            self.queues[0].put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _cleanup(self, job: Dict[str, Any]):
+        # Runs before the future completes, so callers see the job cleaned
+        # up; a failing cleanup must not take the worker thread down
+        if self.cleanup is None:
+            return
+        try:
+            self.cleanup(job)
+        except Exception:
+            pass
+
+    def _forward(self, position: int, item):
+        if position + 1 < len(self.queues):
+            self.queues[position + 1].put(item)
+
+    def _worker(self, position: int):
+        stage = self.stages[position]
+        inbox = self.queues[position]
+        last = position == len(self.stages) - 1
+
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                # The last worker of a stage to stop passes the signal on
+                with stage.lock:
+                    stage.stopped += 1
+                    final = stage.stopped == stage.workers
+                if final and not last:
+                    for _ in range(self.stages[position + 1].workers):
+                        self.queues[position + 1].put(_STOP)
+                return
+
+            job, future, queued_at = item
+            started = time.monotonic()
+            ran = failed = False
+
+            if not future.done() and (not job["done"] or stage.name in self.always_run):
+                ran = True
+                try:
+                    stage.func(job)
+                except Exception as exc:
+                    failed = True
+                    self._cleanup(job)
+                    future.set_exception(exc)
+
+            finished = time.monotonic()
+            stage.record(finished - started, started - queued_at, ran, failed)
+
+            if last:
+                if not future.done():
+                    self._cleanup(job)
+                    future.set_result(job)
+            else:
+                self._forward(position, (job, future, finished))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Per-stage throughput and utilization. The stage with the highest
+        utilization (busy time / worker time available) is the bottleneck.
+        """
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+
+        stages = []
+        for stage, inbox in zip(self.stages, self.queues):
+            with stage.lock:
+                handled = stage.processed + stage.errors
+                stages.append({
+                    "stage": stage.name,
+                    "workers": stage.workers,
+                    "processed": stage.processed,
+                    "skipped": stage.skipped,
+                    "errors": stage.errors,
+                    "queued": inbox.qsize(),
+                    "busy_seconds": round(stage.busy_seconds, 3),
+                    "avg_seconds": round(stage.busy_seconds / handled, 3) if handled else 0.0,
+                    "avg_wait_seconds": round(
+                        stage.wait_seconds / (handled + stage.skipped), 3
+                    ) if handled + stage.skipped else 0.0,
+                    "utilization": round(
+                        stage.busy_seconds / (stage.workers * elapsed), 3
+                    ) if elapsed else 0.0,
+                })
+
+        busiest = max(stages, key=lambda s: s["utilization"], default=None)
+        return {
+            "uptime_seconds": round(elapsed, 3),
+            "bottleneck": busiest["stage"] if busiest and busiest["utilization"] else None,
+            "stages": stages,
+        }
+
+
+# Stages of the document pipeline. Each receives the job dict and reads what
+# earlier stages stored on it. The *_duplicate and template stages answer
+# from earlier results instead of the LLM: they set job["outcome"] and
+# job["done"], and the remaining stages up to persist pass the job through.
+
+def _reuse(document: Any, task_description: Optional[str]) -> Optional[Dict[str, Any]]:
+    extraction = duplicates.stored_extraction(document, task_description)
+    if extraction is None:
+        return None
+    return {
+        "llm_output": extraction.llm_output,
+        "fields": extraction.fields,
+        "source": "duplicate",
+        "duplicate_of": document.pk,
+    }
+
+
+def exact_duplicate_stage(job: Dict[str, Any]):
+    # Byte-identical re-upload: reuse the stored OCR, and the extraction too
+    # when it was made for the same request
+    job["content_hash"] = duplicates.content_hash(job["image_path"])
+    exact = duplicates.find_exact(job["content_hash"])
+    if exact is None:
+        return
+
+    job["ocr_lines"] = duplicates.stored_ocr_lines(exact)
+    job["page_size"] = duplicates.stored_page_size(exact)
+    job["image_hash"] = exact.image_hash
+
+    outcome = _reuse(exact, job["task_description"])
+    if outcome is not None:
+        job["outcome"], job["done"] = outcome, True
+
+
+def decode_stage(job: Dict[str, Any]):
+    if "ocr_lines" in job:
+        return
+
+    # None for files PIL can't read (e.g. PDFs), which the OCR engine opens itself
+    size = images.check_pixel_limit(job["image_path"])
+    job["page_size"] = size
+
+    # Hold memory budget from decoding until OCR is done, so several huge
+    # scans aren't decoded at once; the LLM call runs without it
+    job["reservation"] = memory.get_memory_budget().acquire(
+        memory.estimate_request_bytes(size),
+        timeout=getattr(settings, "MEMORY_ADMISSION_TIMEOUT", None),
+    )
+    if size is not None:
+        job["image"], _ = images.decode_image(
+            job["image_path"], getattr(settings, "OCR_DECODE_MAX_SIDE", None)
+        )
+
+
+def preprocess_stage(job: Dict[str, Any]):
+    image = job.pop("image", None)
+    if image is None:
+        job.setdefault("image_hash", "")
+        return
+
+    job["image_hash"] = duplicates.image_hash(image)
+    job["pixels"], job["scale"] = images.prepare_for_ocr(
+        image, job["page_size"], getattr(settings, "OCR_DECODE_MAX_SIDE", None)
+    )
+
+
+def ocr_stage(job: Dict[str, Any]):
+    if "ocr_lines" in job:
+        return
+
+    pixels = job.pop("pixels", None)
+    try:
+        job["ocr_lines"] = tools.read_document(job["image_path"], pixels, job.get("scale", 1.0))
+    except Exception as exc:
+        # Same as the OCR tool: the LLM stage falls back to running it itself
+        job["ocr_lines"] = [{"error": f"OCR failed: {exc}"}]
+    finally:
+        release_memory(job)
+
+
+def near_duplicate_stage(job: Dict[str, Any]):
+    # Re-scans, re-compressions and screenshots of a stored document
+    candidates = duplicates.image_candidates(job["image_hash"])
+    document, _ = duplicates.find_near_duplicate(ocr_lines_to_text(job["ocr_lines"]), candidates)
+    if document is None:
+        return
+
+    outcome = _reuse(document, job["task_description"])
+    if outcome is not None:
+        job["outcome"], job["done"] = outcome, True
+
+
+def template_stage(job: Dict[str, Any]):
+    # Known layout: read the fields from the learned template's regions
+    match = layouts.extract_with_template(
+        job["ocr_lines"], job["page_size"], job["task_description"]
+    )
+    if match is None:
+        return
+
+    job["outcome"] = {
+        "llm_output": json.dumps(match["fields"], indent=2),
+        "fields": match["fields"],
+        "source": "template",
+        "template_id": match["template"].pk,
+        "confidence": match["confidence"],
+    }
+    job["done"] = True
+
+
+def compact_stage(job: Dict[str, Any]):
+    document_text = f"Document path:\n{job['image_path']}\n"
+    ocr_text = compact_ocr_lines(job["ocr_lines"])
+    if ocr_text:
+        document_text += f"\nOCR text ([x,y] position, then text):\n{ocr_text}\n"
+    job["document_text"] = document_text
+
+
+def llm_stage(job: Dict[str, Any]):
+    outcome = run_llm_document_extraction(
+        image_path=job["image_path"],
+        task_description=job["task_description"],
+        document_text=job["document_text"],
+        **job.get("llm_kwargs", {}),
+    )
+    outcome["fields"] = storage.parse_fields(outcome["llm_output"])
+    outcome["source"] = "llm"
+    job["outcome"] = outcome
+
+
+def persist_stage(job: Dict[str, Any]):
+    """
+    Store the document and its extraction, feed LLM results back into the
+    layout templates and assemble the response.
+    """
+    outcome = job["outcome"]
+    ocr_lines = [item for item in job["ocr_lines"] if "text" in item]
+    ocr_text = ocr_lines_to_text(ocr_lines)
+
+    document = storage.save_extraction(
+        image_path=job["image_path"],
+        ocr_items=ocr_lines,
+        llm_output=outcome["llm_output"],
+        task_description=job["task_description"],
+        model_name=outcome.get("model_name", ""),
+        original_name=job.get("original_name", ""),
+        fields=outcome.get("fields"),
+        source=outcome["source"],
+        template_id=outcome.get("template_id"),
+        confidence=outcome.get("confidence"),
+        page_size=job["page_size"],
+        content_hash=job["content_hash"],
+        image_hash=job["image_hash"],
+        numbers=duplicates.page_numbers(ocr_text),
+        text_signature=duplicates.text_signature(ocr_text),
+    )
+
+    if outcome["source"] == "llm":
+        layouts.learn_template(
+            ocr_lines, outcome["fields"], job["page_size"], job["task_description"]
+        )
+
+    job["result"] = dict(
+        outcome,
+        success=True,
+        ocr_output=ocr_text,
+        image_path=job["image_path"],
+        document_id=document.pk,
+    )
+
+
+def release_memory(job: Dict[str, Any]):
+    """
+    Drop the decoded page and return the job's memory budget. Also runs as
+    the pipeline cleanup, for jobs that failed before reaching OCR.
+    """
+    job.pop("image", None)
+    job.pop("pixels", None)
+    reservation = job.pop("reservation", None)
+    if reservation is not None:
+        reservation.release()
+
+
+def _with_db(func):
+    # Worker threads are long-lived; drop stale connections like a request would
+    def wrapper(job):
+        close_old_connections()
+        try:
+            func(job)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+STAGES = [
+    ("exact_duplicate", _with_db(exact_duplicate_stage), 1),
+    ("decode", decode_stage, 2),
+    ("preprocess", preprocess_stage, 1),
+    ("ocr", ocr_stage, 1),
+    ("near_duplicate", _with_db(near_duplicate_stage), 1),
+    ("template", _with_db(template_stage), 1),
+    ("compact", compact_stage, 1),
+    ("llm", llm_stage, 4),
+    ("persist", _with_db(persist_stage), 1),
+]
+
+_pipeline: Optional[StagePipeline] = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> StagePipeline:
+    """
+    Process-wide pipeline shared by all requests, so their stages overlap.
+    Worker counts come from settings.PIPELINE_WORKERS.
+    """
+    global _pipeline
+
+    with _pipeline_lock:
+        if _pipeline is None:
+            workers = getattr(settings, "PIPELINE_WORKERS", {})
+            _pipeline = StagePipeline(
+                [Stage(name, func, workers.get(name, count)) for name, func, count in STAGES],
+                queue_size=getattr(settings, "PIPELINE_QUEUE_SIZE", 8),
+                always_run=["persist"],
+                cleanup=release_memory,
+            )
+        return _pipeline
+
+
+def run_document_extraction(
+    image_path: str,
+    task_description: Optional[str] = None,
+    original_name: str = "",
+    **llm_kwargs: Any,
+) -> Dict[str, Any]:
+    """
+    Process one document through the shared pipeline and store the result.
+    It is answered as cheaply as possible:
+
+    - byte-identical re-uploads reuse the stored OCR and extraction
+    - near-duplicates (re-scans, re-compressions, screenshots) reuse the
+      stored extraction once their OCR text confirms the match
+    - pages matching a learned layout template are read from its regions
+    - everything else goes to the LLM agent, whose results are fed back
+      so recurring layouts become templates
+    """
+    job = get_pipeline().run({
+        "image_path": image_path,
+        "task_description": task_description,
+        "original_name": original_name,
+        "llm_kwargs": llm_kwargs,
+    })
+    return job["result"]
+
+
+def process_documents(
+    image_paths: List[str],
+    task_description: Optional[str] = None,
+    **llm_kwargs: Any,
+) -> List[Dict[str, Any]]:
+    """
+    Batch variant of `run_document_extraction`; documents overlap across
+    stages and results come back in input order.
+    """
+    jobs = get_pipeline().map(
+        {
+            "image_path": path,
+            "task_description": task_description,
+            "original_name": path,
+            "llm_kwargs": llm_kwargs,
+        }
+        for path in image_paths
+    )
+    return [job["result"] for job in jobs]
@@ -0,0 +1,172 @@
+from typing import Any, Dict, Iterable, List
+
+from django.db import connection
+
+from document_processor.models import Document, Extraction, OcrLine
+
+SEARCH_TABLE = "document_processor_search"
+
+
+def fts_enabled() -> bool:
+    return connection.vendor == "sqlite"
+
+
+def _index_rows(document: Document, lines: Iterable[OcrLine], extraction: Extraction):
+    for line in lines:
+        yield (line.text, document.pk, line.page.number, line.pk, "ocr", "")
+
+    if extraction is None:
+        return
+
+    if extraction.fields:
+        for name, value in extraction.fields.items():
+            yield (str(value), document.pk, None, None, "field", str(name))
+    elif extraction.llm_output:
+        yield (extraction.llm_output, document.pk, None, None, "llm", "")
+
+
+def index_document(document: Document, lines: Iterable[OcrLine], extraction: Extraction = None):
+    """
+    Add a document's OCR lines and extracted fields to the FTS index in one batch.
+    """
+    if not fts_enabled():
+        return
+
+    rows = list(_index_rows(document, lines, extraction))
+    if not rows:
+        return
+
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} "
+            "(text, document_id, page_number, line_id, kind, field_name) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            rows,
+        )
+
+
+def remove_document(document_id: int):
+    if not fts_enabled():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {SEARCH_TABLE} WHERE document_id = %s", [document_id]
+        )
+
+
+def rebuild_index():
+    """
+    Recreate the index from the stored models, e.g. after a bulk import.
+    """
+    if not fts_enabled():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+
+    documents = Document.objects.prefetch_related("pages__lines", "extractions")
+    for document in documents.iterator(chunk_size=200):
+        lines = [line for page in document.pages.all() for line in page.lines.all()]
+        extractions = list(document.extractions.all())
+
+        index_document(document, lines, extractions[0] if extractions else None)
+        for extraction in extractions[1:]:
+            index_document(document, [], extraction)
+
+
+def build_match_query(query: str) -> str:
+    """
+    Quote every term so user input can't break FTS5 query syntax.
+    Terms ending in '*' stay prefix queries.
+    """
+    terms = []
+    for term in query.split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*").replace('"', '""')
+        if term:
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def _fts_matches(query: str, max_matches: int) -> List[Dict[str, Any]]:
+    match_query = build_match_query(query)
+    if not match_query:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT document_id, page_number, line_id, kind, field_name, text "
+            f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s "
+            "ORDER BY rank LIMIT %s",
+            [match_query, max_matches],
+        )
+        rows = cursor.fetchall()
+
+    return [
+        {
+            "document_id": int(document_id),
+            "page": page_number,
+            "line_id": line_id,
+            "kind": kind,
+            "field": field_name or None,
+            "text": text,
+        }
+        for document_id, page_number, line_id, kind, field_name, text in rows
+    ]
+
+
+def _orm_matches(query: str, max_matches: int) -> List[Dict[str, Any]]:
+    lines = OcrLine.objects.select_related("page")
+    for term in query.split():
+        lines = lines.filter(text__icontains=term.rstrip("*"))
+
+    return [
+        {
+            "document_id": line.page.document_id,
+            "page": line.page.number,
+            "line_id": line.pk,
+            "kind": "ocr",
+            "field": None,
+            "text": line.text,
+        }
+        for line in lines[:max_matches]
+    ]
+
+
+def search(query: str, limit: int = 20, max_matches: int = 500) -> List[Dict[str, Any]]:
+    """
+    Return matching documents (best first) with the line locations that matched.
+    """
+    if fts_enabled():
+        matches = _fts_matches(query, max_matches)
+    else:
+        matches = _orm_matches(query, max_matches)
+
+    line_ids = [m["line_id"] for m in matches if m["line_id"] is not None]
+    lines = OcrLine.objects.only("x_min", "y_min", "x_max", "y_max", "confidence").in_bulk(line_ids)
+
+    document_ids = list(dict.fromkeys(m["document_id"] for m in matches))[:limit]
+    documents = Document.objects.in_bulk(document_ids)
+
+    results: Dict[int, Dict[str, Any]] = {}
+    for match in matches:
+        document = documents.get(match["document_id"])
+        if document is None:
+            continue
+
+        entry = results.setdefault(document.pk, {
+            "document_id": document.pk,
+            "image_path": document.image_path,
+            "original_name": document.original_name,
+            "created_at": document.created_at.isoformat(),
+            "matches": [],
+        })
+
+        line = lines.get(match["line_id"])
+        if line is not None:
+            match["bbox"] = line.bbox
+            match["confidence"] = line.confidence
+        entry["matches"].append(match)
+
+    return list(results.values())
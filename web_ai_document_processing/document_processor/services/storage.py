@@ -0,0 +1,112 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.db import transaction
+
+from document_processor.models import Document, Extraction, OcrLine, Page
+from document_processor.services import search
+
+# "- Invoice number: 123" / "Total: 45.00" style lines from bullet answers
+_FIELD_LINE = re.compile(r"^\s*[-*•]?\s*\**([A-Za-z][\w /()-]{0,60}?)\**\s*:\s*(.+?)\s*$")
+
+
+def parse_fields(llm_output: str) -> Dict[str, Any]:
+    """
+    Best-effort conversion of the agent answer into a flat field dict.
+    """
+    if not llm_output:
+        return {}
+
+    start, end = llm_output.find("{"), llm_output.rfind("}")
+    if start != -1 and end > start:
+        try:
+            data = json.loads(llm_output[start:end + 1])
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+
+    fields: Dict[str, Any] = {}
+    for line in llm_output.splitlines():
+        match = _FIELD_LINE.match(line)
+        if match:
+            key = match.group(1).strip().lower().replace(" ", "_")
+            fields[key] = match.group(2)
+    return fields
+
+
+def build_ocr_lines(page: Page, ocr_items: List[Dict[str, Any]]) -> List[OcrLine]:
+    """
+    Turn OCR tool output into unsaved OcrLine rows for bulk insertion.
+    """
+    lines: List[OcrLine] = []
+
+    for item in ocr_items:
+        if "text" not in item:
+            continue
+
+        bbox = item.get("bbox") or [None] * 4
+        lines.append(OcrLine(
+            page=page,
+            index=len(lines),
+            text=item["text"],
+            x_min=bbox[0],
+            y_min=bbox[1],
+            x_max=bbox[2],
+            y_max=bbox[3],
+            confidence=item.get("confidence"),
+        ))
+
+    return lines
+
+
+def save_extraction(
+    image_path: str,
+    ocr_items: List[Dict[str, Any]],
+    llm_output: str,
+    task_description: Optional[str] = None,
+    model_name: str = "",
+    original_name: str = "",
+    fields: Optional[Dict[str, Any]] = None,
+    source: str = "llm",
+    template_id: Optional[int] = None,
+    confidence: Optional[float] = None,
+    page_size: Optional[Tuple[int, int]] = None,
+    content_hash: str = "",
+    image_hash: str = "",
+    numbers: Optional[List[str]] = None,
+    text_signature: Optional[List[int]] = None,
+) -> Document:
+    """
+    Persist one pipeline run and add it to the full-text search index.
+    """
+    with transaction.atomic():
+        document = Document.objects.create(
+            image_path=image_path,
+            original_name=original_name,
+            content_hash=content_hash,
+            image_hash=image_hash,
+            numbers=numbers or [],
+            text_signature=text_signature or [],
+        )
+        width, height = page_size or (None, None)
+        page = Page.objects.create(
+            document=document, number=1, width=width, height=height
+        )
+        lines = OcrLine.objects.bulk_create(build_ocr_lines(page, ocr_items))
+
+        extraction = Extraction.objects.create(
+            document=document,
+            task_description=task_description or "",
+            llm_output=llm_output or "",
+            fields=parse_fields(llm_output) if fields is None else fields,
+            model_name=model_name,
+            source=source,
+            template_id=template_id,
+            confidence=confidence,
+        )
+
+        search.index_document(document, lines, extraction)
+
+    return document
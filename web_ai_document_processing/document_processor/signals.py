@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from document_processor.models import Document
+from document_processor.services import search
+
+
+@receiver(post_delete, sender=Document)
+def remove_from_search_index(sender, instance, **kwargs):
+    # The FTS table has no foreign keys, so deletes don't cascade into it
+    search.remove_document(instance.pk)
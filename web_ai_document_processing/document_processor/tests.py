@@ -1,3 +1,873 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from langchain.tools import tool
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from PIL import Image
+
+from document_processor.models import Document, LayoutTemplate
+from document_processor.services import duplicates, images, layouts, memory, ocr, search, storage
+from document_processor.services.pipeline import Stage, StagePipeline, compact_ocr_lines, release_memory
+from document_processor.services.llm import (
+    CACHE_CONTROL,
+    UsageCallback,
+    build_extraction_agent,
+    build_user_message,
+    min_cacheable_tokens,
+    plan_cache_breakpoints,
+)
+
+
+@tool
+def ocr_read_document(image_path: str) -> str:
+    """
+    Read the text of a document image.
+    """
+    return "Invoice INV-7\nTotal: 45.00 EUR"
+
+
+class FakeCachingChatModel(BaseChatModel):
+    """
+    Stands in for ChatAnthropic: records the cache-control markers of every
+    request and simulates the prompt cache, so a prefix ending at a marker
+    is written on first use and read on later calls. Like the real API it
+    ignores markers whose prefix is shorter than `min_cacheable_tokens`
+    (claude-3-haiku's 2048 by default); tokens are counted as 4 characters.
+    """
+    responses: List[AIMessage] = []
+    tools: List[Dict[str, Any]] = []
+    requests: List[Dict[str, Any]] = []
+    cached_prefixes: set = set()
+    min_cacheable_tokens: int = 2048
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-caching"
+
+    def bind_tools(self, tools, **kwargs):
+        self.tools = [dict(t) for t in tools]
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        # Flatten the request in Anthropic's prefix order: tools, system, messages
+        blocks = [(repr(schema), "cache_control" in schema) for schema in self.tools]
+        for message in messages:
+            content = message.content
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            for block in content:
+                text = block.get("text", "") if isinstance(block, dict) else str(block)
+                marked = isinstance(block, dict) and "cache_control" in block
+                blocks.append((f"{message.type}:{text}", marked))
+
+        markers = [i for i, (_, marked) in enumerate(blocks) if marked]
+        self.requests.append({"messages": messages, "markers": markers})
+
+        cache_read = cache_creation = 0
+        for marker in markers:
+            prefix = "".join(text for text, _ in blocks[:marker + 1])
+            tokens = len(prefix) // 4
+            if tokens < self.min_cacheable_tokens:
+                continue
+            if prefix in self.cached_prefixes:
+                cache_read = tokens
+            else:
+                self.cached_prefixes.add(prefix)
+                cache_creation = tokens - cache_read
+
+        total = sum(len(text) for text, _ in blocks) // 4
+        message = self.responses.pop(0).model_copy()
+        message.usage_metadata = {
+            "input_tokens": total,
+            "output_tokens": 5,
+            "total_tokens": total + 5,
+            "input_token_details": {
+                "cache_read": cache_read,
+                "cache_creation": cache_creation,
+            },
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def final_answer(text: str = "- Total: 45.00") -> AIMessage:
+    return AIMessage(content=text)
+
+
+def tool_call(image_path: str) -> AIMessage:
+    return AIMessage(
+        content="",
+        tool_calls=[{
+            "name": "ocr_read_document",
+            "args": {"image_path": image_path},
+            "id": "call_1",
+        }],
+    )
+
+
+SHORT_PROMPT = "You are a document extraction assistant."
+
+# ~2500 tokens of static field definitions: enough for claude-3-haiku's minimum
+LONG_PROMPT = SHORT_PROMPT + "\n" + "\n".join(
+    f"- field_{n}: the value printed next to label {n}, copied verbatim." for n in range(160)
+)
+
+
+class PromptCachingTests(SimpleTestCase):
+
+    def run_agent(
+        self,
+        llm: FakeCachingChatModel,
+        document: str,
+        instruction: str = "Extract the invoice total.",
+        system_prompt: str = LONG_PROMPT,
+        model_name: str = "claude-3-haiku-20240307",
+    ) -> Optional[Dict[str, int]]:
+        breakpoints = plan_cache_breakpoints(
+            model_name, [ocr_read_document], system_prompt, instruction
+        )
+        agent = build_extraction_agent(
+            tools_list=[ocr_read_document],
+            system_prompt=system_prompt,
+            model_name=model_name,
+            llm=llm,
+            breakpoints=breakpoints,
+        )
+        usage = UsageCallback()
+        agent.invoke(
+            {"messages": [build_user_message(instruction, document, cache=breakpoints["instruction"])]},
+            config={"callbacks": [usage]},
+        )
+        return usage.usage
+
+    def test_fake_ignores_markers_below_the_minimum_prefix(self):
+        # Marking a short prefix anyway has no effect, as with the real API
+        llm = FakeCachingChatModel(responses=[final_answer(), final_answer()])
+        agent = build_extraction_agent(
+            tools_list=[ocr_read_document],
+            system_prompt=SHORT_PROMPT,
+            llm=llm,
+            breakpoints={"tools": True, "system": True},
+        )
+
+        for path in ("/a.png", "/b.png"):
+            usage = UsageCallback()
+            agent.invoke(
+                {"messages": [build_user_message("Extract the total.", path, cache=True)]},
+                config={"callbacks": [usage]},
+            )
+            self.assertEqual(len(llm.requests[-1]["markers"]), 3)
+            self.assertEqual(usage.usage["cache_read_input_tokens"], 0)
+            self.assertEqual(usage.usage["cache_creation_input_tokens"], 0)
+
+    def test_short_prompt_gets_no_breakpoints(self):
+        llm = FakeCachingChatModel(responses=[final_answer()])
+        self.run_agent(llm, "Document path:\n/a.png", system_prompt=SHORT_PROMPT)
+
+        self.assertEqual(llm.requests[0]["markers"], [])
+        self.assertNotIn("cache_control", llm.tools[-1])
+
+    def test_minimum_depends_on_the_model(self):
+        medium = LONG_PROMPT[:6000]  # ~1500 tokens
+
+        haiku = plan_cache_breakpoints("claude-3-haiku-20240307", [ocr_read_document], medium)
+        sonnet = plan_cache_breakpoints("claude-3-5-sonnet-20241022", [ocr_read_document], medium)
+
+        self.assertEqual(min_cacheable_tokens("claude-3-haiku-20240307"), 2048)
+        self.assertFalse(haiku["system"])
+        self.assertTrue(sonnet["system"])
+
+    def test_stable_prefix_comes_before_the_document(self):
+        llm = FakeCachingChatModel(responses=[final_answer()])
+        self.run_agent(llm, "Document path:\n/a.png")
+
+        system, user = llm.requests[0]["messages"][:2]
+        self.assertEqual(system.type, "system")
+        self.assertEqual(system.content[0]["cache_control"], CACHE_CONTROL)
+
+        instruction, document = user.content
+        self.assertIn("Extract the invoice total.", instruction["text"])
+        self.assertEqual(instruction["cache_control"], CACHE_CONTROL)
+        self.assertIn("/a.png", document["text"])
+        self.assertNotIn("cache_control", document)
+
+        # The tool schema alone is far below the minimum, so it isn't marked
+        self.assertNotIn("cache_control", llm.tools[-1])
+        self.assertEqual(len(llm.requests[0]["markers"]), 2)
+
+    def test_usage_reports_cache_writes_then_reads(self):
+        llm = FakeCachingChatModel(responses=[final_answer(), final_answer()])
+
+        first = self.run_agent(llm, "Document path:\n/a.png")
+        second = self.run_agent(llm, "Document path:\n/b.png")
+
+        self.assertGreaterEqual(first["cache_creation_input_tokens"], 2048)
+        self.assertEqual(first["cache_read_input_tokens"], 0)
+        self.assertGreaterEqual(second["cache_read_input_tokens"], 2048)
+        self.assertEqual(second["cache_creation_input_tokens"], 0)
+
+    def test_usage_is_summed_over_agent_steps(self):
+        llm = FakeCachingChatModel(responses=[tool_call("/a.png"), final_answer()])
+        usage = self.run_agent(llm, "Document path:\n/a.png")
+
+        self.assertEqual(len(llm.requests), 2)
+        self.assertEqual(usage["output_tokens"], 10)
+        # The follow-up call after the tool result re-reads the cached prefix
+        self.assertGreater(usage["cache_read_input_tokens"], 0)
+
+
+INVOICE_LINES = [
+    {"text": "ACME Corp", "bbox": [10, 10, 200, 40], "confidence": 0.99},
+    {"text": "Invoice INV-7", "bbox": [10, 60, 220, 90], "confidence": 0.97},
+    {"text": "Total: 45.00 EUR", "bbox": [10, 300, 260, 330], "confidence": 0.91},
+]
+
+
+def save_invoice(**kwargs) -> Document:
+    options = {
+        "image_path": "/uploads/a.png",
+        "ocr_items": INVOICE_LINES,
+        "llm_output": '{"invoice_number": "INV-7", "total": "45.00"}',
+        "task_description": "Extract the invoice total.",
+        "model_name": "claude-3-haiku-20240307",
+        "page_size": (800, 1000),
+    }
+    options.update(kwargs)
+    return storage.save_extraction(**options)
+
+
+class ParseFieldsTests(SimpleTestCase):
+
+    def test_json_object_inside_text(self):
+        fields = storage.parse_fields('Here you go:\n{"total": "45.00"}\nDone.')
+        self.assertEqual(fields, {"total": "45.00"})
+
+    def test_bullet_lines(self):
+        fields = storage.parse_fields("- Invoice number: INV-7\n* **Total**: 45.00 EUR")
+        self.assertEqual(fields, {"invoice_number": "INV-7", "total": "45.00 EUR"})
+
+    def test_unparseable_output(self):
+        self.assertEqual(storage.parse_fields(""), {})
+        self.assertEqual(storage.parse_fields("Nothing found {oops"), {})
+
+
+class BuildMatchQueryTests(SimpleTestCase):
+
+    def test_terms_are_quoted(self):
+        self.assertEqual(search.build_match_query("acme  total"), '"acme" "total"')
+
+    def test_quotes_and_operators_are_escaped(self):
+        self.assertEqual(
+            search.build_match_query('say "hi" OR NEAR(x'),
+            '"say" """hi""" "OR" "NEAR(x"',
+        )
+
+    def test_trailing_star_keeps_prefix_query(self):
+        self.assertEqual(search.build_match_query("inv* *"), '"inv"*')
+
+
+class SaveExtractionTests(TestCase):
+
+    def test_stores_page_lines_and_extraction(self):
+        document = save_invoice(original_name="a.png")
+
+        page = document.pages.get()
+        self.assertEqual((page.number, page.width, page.height), (1, 800, 1000))
+        lines = list(page.lines.order_by("index"))
+        self.assertEqual([line.text for line in lines], [item["text"] for item in INVOICE_LINES])
+        self.assertEqual(lines[2].bbox, [10, 300, 260, 330])
+
+        extraction = document.extractions.get()
+        self.assertEqual(extraction.fields, {"invoice_number": "INV-7", "total": "45.00"})
+        self.assertEqual(extraction.source, "llm")
+
+
+class SearchTests(TestCase):
+
+    def test_returns_line_location_and_confidence(self):
+        document = save_invoice()
+
+        results = search.search("total")
+
+        self.assertEqual([r["document_id"] for r in results], [document.pk])
+        match = next(m for m in results[0]["matches"] if m["kind"] == "ocr")
+        self.assertEqual(match["text"], "Total: 45.00 EUR")
+        self.assertEqual(match["bbox"], [10, 300, 260, 330])
+        self.assertAlmostEqual(match["confidence"], 0.91)
+
+    def test_finds_extracted_fields(self):
+        document = save_invoice()
+
+        matches = search.search("INV-7")[0]["matches"]
+
+        self.assertEqual(matches[0]["document_id"], document.pk)
+        self.assertIn("invoice_number", [m["field"] for m in matches])
+
+    def test_deleted_documents_leave_the_index(self):
+        kept, deleted = save_invoice(), save_invoice(image_path="/uploads/b.png")
+        deleted.delete()
+
+        self.assertEqual([r["document_id"] for r in search.search("total")], [kept.pk])
+        # search() skips missing documents, so check the index rows themselves
+        if search.fts_enabled():
+            indexed = {m["document_id"] for m in search._fts_matches("total", 10)}
+            self.assertEqual(indexed, {kept.pk})
+
+    def test_rebuild_command_restores_the_index(self):
+        document = save_invoice()
+        search.remove_document(document.pk)
+        self.assertEqual(search.search("total"), [])
+
+        call_command("rebuild_search_index", stdout=StringIO())
+
+        self.assertEqual([r["document_id"] for r in search.search("total")], [document.pk])
+
+
+PAGE_SIZE = (1000, 1000)
+
+
+def vendor_page(number: str = "INV-7", total: str = "45.00", shift: int = 0) -> List[Dict[str, Any]]:
+    """
+    OCR output of one vendor's invoice layout; `shift` moves every line down.
+    """
+    rows = [
+        ("ACME Corporation", [50, 40, 400, 80]),
+        ("Invoice", [700, 40, 900, 80]),
+        ("Bill To", [50, 200, 200, 230]),
+        ("Payment Terms", [50, 700, 300, 730]),
+        (f"Invoice number: {number}", [50, 120, 400, 150]),
+        (f"Total: {total}", [600, 800, 900, 840]),
+    ]
+    return [
+        {"text": text, "bbox": [x0, y0 + shift, x1, y1 + shift], "confidence": 0.95}
+        for text, (x0, y0, x1, y1) in rows
+    ]
+
+
+class LayoutFingerprintTests(SimpleTestCase):
+
+    def test_anchors_skip_lines_with_digits(self):
+        anchors = layouts.fingerprint(vendor_page(), PAGE_SIZE)
+
+        self.assertEqual(
+            [anchor[0] for anchor in anchors],
+            ["acmecorporation", "invoice", "billto", "paymentterms"],
+        )
+        self.assertEqual(anchors[1][1:], [0.8, 0.06])
+
+    def test_similarity_tolerates_small_shifts_only(self):
+        base = layouts.fingerprint(vendor_page(), PAGE_SIZE)
+
+        self.assertEqual(layouts.similarity(base, layouts.fingerprint(vendor_page(shift=10), PAGE_SIZE)), 1.0)
+        self.assertEqual(layouts.similarity(base, layouts.fingerprint(vendor_page(shift=100), PAGE_SIZE)), 0.0)
+
+
+class LayoutTemplateTests(TestCase):
+    task = "Extract the invoice number and total."
+
+    def setUp(self):
+        patcher = mock.patch.object(layouts, "_index", layouts.TemplateIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def learn(self, fields: Dict[str, Any], **page) -> LayoutTemplate:
+        return layouts.learn_template(vendor_page(**page), fields, PAGE_SIZE, self.task)
+
+    def test_template_is_trusted_after_two_agreeing_samples(self):
+        first = self.learn({"invoice_number": "INV-7", "total": "45.00"})
+        self.assertIsNone(layouts.extract_with_template(vendor_page("INV-8", "12.50"), PAGE_SIZE, self.task))
+
+        second = self.learn({"invoice_number": "INV-8", "total": "12.50"}, number="INV-8", total="12.50")
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(LayoutTemplate.objects.count(), 1)
+
+        match = layouts.extract_with_template(vendor_page("INV-9", "99.90"), PAGE_SIZE, self.task)
+        self.assertEqual(match["fields"], {"invoice_number": "INV-9", "total": "99.90"})
+        self.assertEqual(match["template"].pk, first.pk)
+
+    def test_templates_are_per_request(self):
+        self.learn({"total": "45.00"})
+        self.learn({"total": "12.50"}, total="12.50")
+
+        self.assertIsNone(layouts.extract_with_template(vendor_page(), PAGE_SIZE, "Other request"))
+
+    def test_inferred_fields_fall_back_to_the_llm(self):
+        # "currency" is never printed on the page, so it can't be located
+        self.learn({"total": "45.00", "currency": "USD"})
+        template = self.learn({"total": "12.50", "currency": "USD"}, total="12.50")
+
+        self.assertEqual(template.expected_fields, ["currency", "total"])
+        self.assertIsNone(layouts.extract_with_template(vendor_page(total="7.00"), PAGE_SIZE, self.task))
+
+    def test_field_missing_from_one_sample_is_still_expected(self):
+        self.learn({"total": "45.00", "invoice_number": "INV-7"})
+        self.learn({"total": "12.50", "invoice_number": None}, total="12.50", number="INV-8")
+
+        self.assertIsNone(layouts.extract_with_template(vendor_page("INV-9", "99.10"), PAGE_SIZE, self.task))
+
+    def test_reformatted_numeric_values_are_not_learned(self):
+        # The default task asks for bare numbers: JSON 45.0 for "Total: 45.00"
+        self.learn({"total": 45.0})
+        template = self.learn({"total": 12.5}, total="12.50")
+
+        self.assertIsNone(template)
+        self.assertIsNone(layouts.extract_with_template(vendor_page(total="99.10"), PAGE_SIZE, self.task))
+
+    def test_value_differing_from_the_page_text_is_not_learned(self):
+        page = vendor_page(total="$1,234.50")
+        lines = layouts._normalized_boxes(page, PAGE_SIZE)
+
+        self.assertIsNone(layouts._locate_field(lines, "1234.50"))
+        self.assertEqual(layouts._locate_field(lines, "$1,234.50")["prefix"], "Total:")
+
+    def test_moved_field_recovers_after_consistent_samples(self):
+        self.learn({"total": "45.00"})
+        self.learn({"total": "12.50"}, total="12.50")
+        # The LLM picked a different line for "total" once
+        template = self.learn({"total": "INV-8"}, number="INV-8")
+        self.assertFalse(layouts._is_trusted(template))
+
+        template = self.learn({"total": "INV-9"}, number="INV-9")
+        self.assertTrue(layouts._is_trusted(template))
+        self.assertEqual(template.field_regions["total"]["streak"], 2)
+
+    def test_stale_singletons_are_pruned(self):
+        template = self.learn({"total": "45.00"})
+        LayoutTemplate.objects.filter(pk=template.pk).update(
+            updated_at=template.updated_at - timedelta(days=30)
+        )
+
+        with mock.patch.object(layouts, "_pruned_at", None):
+            layouts.prune_singletons()
+
+        self.assertFalse(LayoutTemplate.objects.exists())
+        self.assertEqual(layouts._index.best_match(template.anchors, template.task_key), (None, 0.0))
+
+
+class BKTreeTests(SimpleTestCase):
+
+    def test_search_matches_brute_force(self):
+        rng = random.Random(7)
+        values = [rng.getrandbits(64) for _ in range(300)]
+        tree = duplicates.BKTree()
+        for n, value in enumerate(values):
+            tree.add(value, n)
+
+        query = values[0] ^ 0b1011  # three bits away from the first value
+        for radius in (0, 3, 12, 30):
+            expected = sorted(
+                (duplicates.hamming(query, value), n)
+                for n, value in enumerate(values)
+                if duplicates.hamming(query, value) <= radius
+            )
+            self.assertEqual(sorted(tree.search(query, radius)), expected)
+
+    def test_identical_hashes_share_a_node(self):
+        tree = duplicates.BKTree()
+        tree.add(5, "a")
+        tree.add(5, "b")
+
+        self.assertEqual(tree.search(5, 0), [(0, "a"), (0, "b")])
+
+
+INVOICE_TEXT = (
+    "ACME Corporation Invoice INV-2024-0042 Bill To Example Ltd 12 Main Street "
+    "Consulting services March 1,250.00 Travel expenses 320.50 Subtotal 1,570.50 "
+    "VAT 20% 314.10 Total due 1,884.60 EUR Payment terms 30 days IBAN DE0012345678"
+)
+
+
+class NearDuplicateTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(duplicates, "_index", duplicates.NearDuplicateIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def store(self, text: str) -> Document:
+        return save_invoice(
+            ocr_items=[{"text": text}],
+            numbers=duplicates.page_numbers(text),
+            text_signature=duplicates.text_signature(text),
+        )
+
+    def test_similar_text_shares_lsh_bands(self):
+        a = duplicates.text_signature(INVOICE_TEXT)
+        b = duplicates.text_signature(INVOICE_TEXT.replace("Ltd", "Ltd."))
+        c = duplicates.text_signature("A completely different letter about the weather")
+
+        self.assertEqual(len(a), duplicates.NUM_PERMUTATIONS)
+        self.assertEqual(len(duplicates._bands(a)), duplicates.LSH_BANDS)
+        self.assertEqual(a, b)
+        self.assertFalse(set(duplicates._bands(a)) & set(duplicates._bands(c)))
+
+    def test_numbers_ignore_separator_noise(self):
+        self.assertEqual(
+            duplicates.page_numbers("Total 1,234.56 net 45.00 qty 2"),
+            duplicates.page_numbers("Total 1.234,56 net 45,00 qty 3"),
+        )
+        self.assertEqual(duplicates.number_similarity(["4500"], ["4600"]), 0.0)
+
+    def test_finds_rescan_with_ocr_noise(self):
+        document = self.store(INVOICE_TEXT)
+        rescan = INVOICE_TEXT.replace("320.50", "320,50").replace("Ltd", "Ltd.")
+
+        found, score = duplicates.find_near_duplicate(rescan, [])
+
+        self.assertEqual(found.pk, document.pk)
+        self.assertGreaterEqual(score, duplicates.TEXT_SIMILARITY)
+
+    def test_rejects_same_layout_with_different_amounts(self):
+        self.store(INVOICE_TEXT)
+        other = INVOICE_TEXT.replace("INV-2024-0042", "INV-2024-0043").replace("1,884.60", "1,884.70")
+
+        found, _ = duplicates.find_near_duplicate(other, [])
+
+        self.assertIsNone(found)
+
+    def test_image_candidates_within_radius(self):
+        near = save_invoice(image_hash="00000000000000ff")
+        save_invoice(image_hash="ffffffffffffff00")
+
+        self.assertEqual(duplicates.image_candidates("00000000000000fe"), [near.pk])
+
+
+def recorder(name: str, log: List[Any], lock: threading.Lock):
+    def func(job):
+        with lock:
+            log.append((name, job["n"]))
+    return func
+
+
+class StagePipelineTests(SimpleTestCase):
+
+    def make(self, stages, **kwargs) -> StagePipeline:
+        pipeline = StagePipeline(stages, **kwargs)
+        self.addCleanup(pipeline.close)
+        return pipeline
+
+    def test_map_returns_results_in_input_order(self):
+        rng = random.Random(3)
+        delays = [rng.uniform(0, 0.01) for _ in range(20)]
+
+        def slow(job):
+            time.sleep(delays[job["n"]])
+            job["out"] = job["n"] * 2
+
+        pipeline = self.make([Stage("slow", slow, workers=4)], queue_size=2)
+        jobs = pipeline.map({"n": n} for n in range(20))
+
+        self.assertEqual([job["out"] for job in jobs], [n * 2 for n in range(20)])
+
+    def test_done_skips_later_stages_except_always_run(self):
+        log, lock = [], threading.Lock()
+
+        def finish_odd(job):
+            job["done"] = job["n"] % 2 == 1
+
+        pipeline = self.make(
+            [
+                Stage("check", finish_odd),
+                Stage("work", recorder("work", log, lock)),
+                Stage("persist", recorder("persist", log, lock)),
+            ],
+            always_run=["persist"],
+        )
+        pipeline.map({"n": n} for n in range(4))
+
+        self.assertEqual(sorted(n for name, n in log if name == "work"), [0, 2])
+        self.assertEqual(sorted(n for name, n in log if name == "persist"), [0, 1, 2, 3])
+
+    def test_exception_reaches_future_and_skips_later_stages(self):
+        log, lock = [], threading.Lock()
+
+        def fail_on_one(job):
+            if job["n"] == 1:
+                raise ValueError("bad page")
+
+        pipeline = self.make(
+            [Stage("first", fail_on_one), Stage("persist", recorder("persist", log, lock))],
+            always_run=["persist"],
+        )
+        futures = [pipeline.submit({"n": n}) for n in range(3)]
+
+        with self.assertRaisesMessage(ValueError, "bad page"):
+            futures[1].result(timeout=5)
+        self.assertEqual([f.result(timeout=5)["n"] for f in (futures[0], futures[2])], [0, 2])
+        self.assertEqual(sorted(n for _, n in log), [0, 2])
+
+    def test_close_drains_queued_jobs_and_joins_threads(self):
+        release = threading.Event()
+
+        def blocked(job):
+            release.wait(5)
+            job["out"] = True
+
+        pipeline = StagePipeline(
+            [Stage("blocked", blocked), Stage("next", lambda job: None, workers=2)],
+            queue_size=10,
+        )
+        futures = [pipeline.submit({"n": n}) for n in range(5)]
+
+        closer = threading.Thread(target=pipeline.close)
+        closer.start()
+        release.set()
+        closer.join(5)
+
+        self.assertFalse(closer.is_alive())
+        self.assertTrue(all(f.done() and f.result()["out"] for f in futures))
+        self.assertFalse(any(thread.is_alive() for thread in pipeline.threads))
+
+    def test_stats_count_processed_skipped_and_errors(self):
+        def route(job):
+            if job["n"] == 0:
+                raise RuntimeError("boom")
+            job["done"] = job["n"] == 1
+
+        pipeline = self.make([Stage("route", route), Stage("work", lambda job: None)])
+        for future in [pipeline.submit({"n": n}) for n in range(4)]:
+            future.exception(timeout=5)
+
+        route_stats, work_stats = pipeline.stats()["stages"]
+        self.assertEqual(
+            (route_stats["processed"], route_stats["skipped"], route_stats["errors"]), (3, 0, 1)
+        )
+        self.assertEqual(
+            (work_stats["processed"], work_stats["skipped"], work_stats["errors"]), (2, 2, 0)
+        )
+
+    def test_compact_ocr_lines(self):
+        text = compact_ocr_lines([
+            {"text": "Total: 45.00", "bbox": [10.6, 300.2, 200, 320]},
+            {"text": "no box", "bbox": None},
+            {"error": "OCR failed"},
+        ])
+
+        self.assertEqual(text, "[10,300] Total: 45.00\nno box")
+
+
+class StubRecognizer:
+    """
+    Stands in for PaddleOCR's TextRecognition: returns canned rec_text /
+    rec_score pairs and records the size of every crop it was given.
+    """
+
+    def __init__(self, outputs: List[Dict[str, Any]]):
+        self.outputs = outputs
+        self.crop_sizes: List[tuple] = []
+
+    def predict(self, input, batch_size=1):
+        self.crop_sizes = [crop.shape[:2] for crop in input]
+        return self.outputs[:len(input)]
+
+
+class StubPaddleOCR:
+
+    def __init__(self, page: Dict[str, Any]):
+        self.page = page
+        self.inputs: List[Any] = []
+
+    def predict(self, image):
+        self.inputs.append(image)
+        return [self.page]
+
+
+class OcrRefinementTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.image_path = os.path.join(directory.name, "page.png")
+        Image.new("RGB", (200, 100), "white").save(self.image_path)
+
+    def refine(self, items, outputs) -> StubRecognizer:
+        recognizer = StubRecognizer(outputs)
+        with mock.patch.object(ocr, "get_paddle_recognizer", return_value=recognizer):
+            ocr.refine_low_confidence(self.image_path, items, threshold=0.85, padding=4)
+        return recognizer
+
+    def test_rereads_only_unsure_lines_with_a_box(self):
+        items = [
+            {"text": "Tota1", "bbox": [20, 10, 60, 30], "confidence": 0.5},
+            {"text": "ACME", "bbox": [10, 40, 80, 60], "confidence": 0.99},
+            {"text": "no box", "bbox": None, "confidence": 0.1},
+            {"text": "no score", "bbox": [10, 70, 50, 90]},
+        ]
+        recognizer = self.refine(items, [{"rec_text": "Total", "rec_score": 0.97}])
+
+        self.assertEqual(len(recognizer.crop_sizes), 1)
+        self.assertEqual(items[0], {
+            "text": "Total", "bbox": [20, 10, 60, 30], "confidence": 0.97, "refined": True,
+        })
+        self.assertEqual([item["text"] for item in items[1:]], ["ACME", "no box", "no score"])
+
+    def test_crops_are_padded_and_clamped_to_the_page(self):
+        items = [
+            {"text": "a", "bbox": [20, 10, 60, 30], "confidence": 0.5},
+            {"text": "b", "bbox": [2, 1, 60, 30], "confidence": 0.5},
+            {"text": "c", "bbox": [150, 80, 199, 99], "confidence": 0.5},
+        ]
+        recognizer = self.refine(items, [{"rec_text": "", "rec_score": 0.0}] * 3)
+
+        # (height, width) of (x0-4, y0-4, x1+4, y1+4) clamped to 200x100
+        self.assertEqual(recognizer.crop_sizes, [(28, 48), (34, 64), (24, 54)])
+
+    def test_keeps_text_when_the_reread_scores_lower(self):
+        items = [
+            {"text": "45.0O", "bbox": [150, 80, 199, 99], "confidence": 0.6},
+            {"text": "INV-7", "bbox": [20, 10, 60, 30], "confidence": 0.7},
+        ]
+        self.refine(items, [
+            {"rec_text": "45.00", "rec_score": 0.4},
+            {"rec_text": "", "rec_score": 0.99},
+        ])
+
+        self.assertEqual([item["text"] for item in items], ["45.0O", "INV-7"])
+        self.assertEqual([item["confidence"] for item in items], [0.6, 0.7])
+        self.assertFalse(any("refined" in item for item in items))
+
+    @override_settings(OCR_REFINE_THRESHOLD=0.85, OCR_REFINE_MODEL=None)
+    def test_first_pass_reads_the_downscaled_page(self):
+        engine = StubPaddleOCR({
+            "rec_texts": ["Total", "45.0O"],
+            "rec_scores": [0.99, 0.6],
+            "dt_polys": [[(10, 5), (30, 5), (30, 15), (10, 15)], [(70, 40), (99, 40), (99, 49), (70, 49)]],
+        })
+        recognizer = StubRecognizer([{"rec_text": "45.00", "rec_score": 0.95}])
+        small = object()  # the decoded 100x50 page
+
+        with mock.patch.object(ocr, "get_paddle_instance", return_value=engine), \
+                mock.patch.object(ocr, "get_paddle_recognizer", return_value=recognizer):
+            items = ocr.extract_with_paddle(self.image_path, image=small, scale=2.0)
+
+        self.assertIs(engine.inputs[0], small)
+        # Boxes are mapped back to the 200x100 original before refinement
+        self.assertEqual(items[0]["bbox"], [20.0, 10.0, 60.0, 30.0])
+        self.assertEqual(items[1]["bbox"], [140.0, 80.0, 198.0, 98.0])
+        self.assertEqual(items[1]["text"], "45.00")
+        self.assertEqual(recognizer.crop_sizes, [(24, 64)])
+
+    @override_settings(OCR_REFINE_THRESHOLD=0.85, OCR_REFINE_MODEL=None)
+    def test_full_resolution_pass_is_not_refined_with_the_same_model(self):
+        engine = StubPaddleOCR({
+            "rec_texts": ["45.0O"],
+            "rec_scores": [0.6],
+            "dt_polys": [[(70, 40), (99, 40), (99, 49), (70, 49)]],
+        })
+
+        with mock.patch.object(ocr, "get_paddle_instance", return_value=engine), \
+                mock.patch.object(ocr, "get_paddle_recognizer") as get_recognizer:
+            items = ocr.extract_with_paddle(self.image_path, image=object(), scale=1.0)
+
+        get_recognizer.assert_not_called()
+        self.assertEqual(items[0]["text"], "45.0O")
+
+
+class MemoryBudgetTests(SimpleTestCase):
+
+    def test_reserve_times_out_when_the_budget_is_used_up(self):
+        budget = memory.MemoryBudget(100)
+
+        with budget.reserve(80):
+            with self.assertRaises(memory.MemoryBudgetExceeded):
+                with budget.reserve(30, timeout=0.05):
+                    pass
+
+        self.assertEqual(budget.in_use, 0)
+
+    def test_oversized_request_is_capped_to_run_alone(self):
+        budget = memory.MemoryBudget(100)
+
+        with budget.reserve(500) as amount:
+            self.assertEqual(amount, 100)
+            self.assertEqual(budget.in_use, 100)
+
+    def test_release_wakes_a_waiting_request(self):
+        budget = memory.MemoryBudget(100)
+        first = budget.acquire(70)
+        admitted = threading.Event()
+
+        def wait_for_budget():
+            with budget.reserve(50, timeout=5):
+                admitted.set()
+
+        waiter = threading.Thread(target=wait_for_budget)
+        waiter.start()
+        self.assertFalse(admitted.wait(0.05))
+
+        first.release()
+        first.release()  # releasing twice must not free memory twice
+        waiter.join(5)
+
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(budget.in_use, 0)
+
+    def test_pipeline_cleanup_returns_the_budget_of_failed_jobs(self):
+        budget = memory.MemoryBudget(100)
+
+        def decode(job):
+            job["reservation"] = budget.acquire(60)
+            job["image"] = object()
+
+        def preprocess(job):
+            raise ValueError("corrupt page")
+
+        pipeline = StagePipeline(
+            [Stage("decode", decode), Stage("preprocess", preprocess), Stage("ocr", release_memory)],
+            cleanup=release_memory,
+        )
+        self.addCleanup(pipeline.close)
+
+        future = pipeline.submit({})
+        self.assertIsInstance(future.exception(timeout=5), ValueError)
+        self.assertEqual(budget.in_use, 0)
+
+    def test_profile_samples_rss_during_the_request(self):
+        with memory.MemoryProfile(interval=0.01) as profile:
+            time.sleep(0.03)
+
+        report = profile.report
+        if report["rss_before_bytes"] is not None:
+            self.assertGreaterEqual(report["rss_peak_bytes"], report["rss_before_bytes"])
+            self.assertGreaterEqual(report["rss_peak_bytes"], report["rss_after_bytes"])
+        self.assertIn("process_peak_rss_bytes", report)
+
+
+class PixelLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_image(self, size) -> str:
+        path = os.path.join(self.directory, "page.png")
+        Image.new("RGB", size, "white").save(path)
+        return path
+
+    def test_returns_the_size_of_acceptable_images(self):
+        self.assertEqual(images.check_pixel_limit(self.write_image((300, 200))), (300, 200))
+
+    def test_rejects_images_above_the_limit(self):
+        path = self.write_image((300, 200))
+
+        with mock.patch.object(images, "MAX_IMAGE_PIXELS", 50_000):
+            with self.assertRaises(images.ImageTooLarge):
+                images.check_pixel_limit(path)
+
+    def test_unreadable_files_are_left_to_the_ocr_engine(self):
+        path = os.path.join(self.directory, "scan.pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF-1.4 not an image")
+
+        self.assertIsNone(images.check_pixel_limit(path))
@@ -6,4 +6,7 @@ app_name = "document_processor"  # 👈 THIS IS REQUIRED
 urlpatterns = [
     path('upload/', views.index, name='index'),              # Form page at /api/upload/ (assuming include prefix)
     path('process/', views.process_document, name='process_document'),  # API endpoint at /api/process/
+    path('search/', views.search_documents, name='search_documents'),  # Full-text search at /api/search/?q=
+    path('templates/stats/', views.template_stats, name='template_stats'),  # Layout template skip rate
+    path('pipeline/stats/', views.pipeline_stats, name='pipeline_stats'),  # Per-stage utilization
 ]
\ No newline at end of file
@@ -2,11 +2,15 @@ from django.shortcuts import render
 
 # Create your views here.
 import os
+from contextlib import nullcontext
+
+from django.conf import settings
 from django.http import JsonResponse
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 from django.core.files.storage import default_storage
 
-from document_processor.services.llm import run_llm_document_extraction
+from document_processor.services.pipeline import get_pipeline, run_document_extraction
+from document_processor.services import images, layouts, memory, search
 
 from django.views.decorators.csrf import csrf_exempt
 
@@ -49,13 +53,74 @@ def process_document(request):
     # Pass the user prompt if provided, otherwise use default
     task_description = user_prompt or None
     print(f"Task Description2: {task_description}")
-    result = run_llm_document_extraction(image_path=absolute_path, task_description=task_description)
+    try:
+        images.check_pixel_limit(absolute_path)
+    except images.ImageTooLarge as exc:
+        default_storage.delete(file_path)
+        return JsonResponse({"error": str(exc)}, status=413)
+
+    # Opt-in memory report, for sizing worker pools
+    profile_memory = (
+        request.POST.get("profile_memory") == "1"
+        or getattr(settings, "MEMORY_PROFILE_REQUESTS", False)
+    )
+    profiler = memory.MemoryProfile() if profile_memory else nullcontext()
+
+    # The pipeline holds memory budget around decode and OCR; a request
+    # that can't get it in time is turned away rather than queued forever
+    try:
+        with profiler:
+            result = run_document_extraction(
+                image_path=absolute_path,
+                task_description=task_description,
+                original_name=uploaded_file.name,
+            )
+    except memory.MemoryBudgetExceeded as exc:
+        # Nothing was stored for this upload, so nothing else would delete it
+        default_storage.delete(file_path)
+        return JsonResponse({"error": str(exc)}, status=503)
+
+    if profile_memory:
+        result["memory"] = profiler.report
 
     # Add prompt to response for display
     result["prompt"] = user_prompt or "Default task"
 
     return JsonResponse(result, status=200)
 
+@require_GET
+def search_documents(request):
+    """
+    Full-text search over stored OCR lines and extracted fields.
+    """
+    query = request.GET.get("q", "").strip()
+
+    if not query:
+        return JsonResponse({"error": "Missing query parameter 'q'"}, status=400)
+
+    try:
+        limit = max(1, min(int(request.GET.get("limit", 20)), 100))
+    except ValueError:
+        return JsonResponse({"error": "Invalid limit"}, status=400)
+
+    results = search.search(query, limit=limit)
+
+    return JsonResponse({"query": query, "results": results}, status=200)
+
+@require_GET
+def template_stats(request):
+    """
+    Share of documents answered from layout templates instead of the LLM.
+    """
+    return JsonResponse(layouts.template_stats(), status=200)
+
+@require_GET
+def pipeline_stats(request):
+    """
+    Per-stage utilization of the shared pipeline, to spot the bottleneck.
+    """
+    return JsonResponse(get_pipeline().stats(), status=200)
+
 def index(request):
     """
     Render the main upload interface.
@@ -34,6 +34,50 @@ load_dotenv()
 OCR_ENGINE = os.getenv("OCR_ENGINE", "paddle")
 OCR_SPACE_API_KEY = os.getenv("OCR_SPACE_API_KEY")
 
+# PaddleOCR: the first pass (detection and recognition) reads the page decoded
+# at OCR_DECODE_MAX_SIDE pixels, which also bounds its memory; lines scored
+# below OCR_REFINE_THRESHOLD are then re-read from full-resolution crops
+# (OCR_REFINE_THRESHOLD=0 disables the refinement)
+OCR_DECODE_MAX_SIDE = int(os.getenv("OCR_DECODE_MAX_SIDE", "1600"))
+OCR_REFINE_THRESHOLD = float(os.getenv("OCR_REFINE_THRESHOLD", "0.85"))
+OCR_REFINE_PADDING = int(os.getenv("OCR_REFINE_PADDING", "4"))
+OCR_REFINE_BATCH_SIZE = int(os.getenv("OCR_REFINE_BATCH_SIZE", "16"))
+OCR_REFINE_MODEL = os.getenv("OCR_REFINE_MODEL")  # e.g. PP-OCRv5_server_rec
+
+# Memory: pixel cap for uploads and a per-process budget that queues
+# requests instead of overcommitting
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "60000000"))
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", str(2 * 1024 ** 3)))
+MEMORY_BYTES_PER_PIXEL = int(os.getenv("MEMORY_BYTES_PER_PIXEL", "24"))
+MEMORY_ADMISSION_TIMEOUT = float(os.getenv("MEMORY_ADMISSION_TIMEOUT", "120"))
+MEMORY_PROFILE_REQUESTS = os.getenv("MEMORY_PROFILE_REQUESTS", "0") == "1"
+
+# Layout templates: skip the LLM for recurring document layouts
+LAYOUT_TEMPLATE_MATCH_THRESHOLD = float(os.getenv("LAYOUT_TEMPLATE_MATCH_THRESHOLD", "0.6"))
+LAYOUT_TEMPLATE_CONFIDENCE_THRESHOLD = float(os.getenv("LAYOUT_TEMPLATE_CONFIDENCE_THRESHOLD", "0.8"))
+LAYOUT_TEMPLATE_MIN_SAMPLES = int(os.getenv("LAYOUT_TEMPLATE_MIN_SAMPLES", "2"))
+LAYOUT_TEMPLATE_SINGLETON_DAYS = int(os.getenv("LAYOUT_TEMPLATE_SINGLETON_DAYS", "7"))
+LAYOUT_TEMPLATE_REFRESH_SECONDS = float(os.getenv("LAYOUT_TEMPLATE_REFRESH_SECONDS", "30"))
+
+# Near-duplicate reuse of earlier results
+DUPLICATE_CANDIDATE_DISTANCE = int(os.getenv("DUPLICATE_CANDIDATE_DISTANCE", "12"))
+DUPLICATE_TEXT_SIMILARITY = float(os.getenv("DUPLICATE_TEXT_SIMILARITY", "0.9"))
+DUPLICATE_NUMBER_SIMILARITY = float(os.getenv("DUPLICATE_NUMBER_SIMILARITY", "1.0"))
+
+# Staged pipeline: worker threads per stage and queue size between stages
+PIPELINE_WORKERS = {
+    "exact_duplicate": int(os.getenv("PIPELINE_EXACT_DUPLICATE_WORKERS", "1")),
+    "decode": int(os.getenv("PIPELINE_DECODE_WORKERS", "2")),
+    "preprocess": int(os.getenv("PIPELINE_PREPROCESS_WORKERS", "1")),
+    "ocr": int(os.getenv("PIPELINE_OCR_WORKERS", "1")),
+    "near_duplicate": int(os.getenv("PIPELINE_NEAR_DUPLICATE_WORKERS", "1")),
+    "template": int(os.getenv("PIPELINE_TEMPLATE_WORKERS", "1")),
+    "compact": int(os.getenv("PIPELINE_COMPACT_WORKERS", "1")),
+    "llm": int(os.getenv("PIPELINE_LLM_WORKERS", "4")),
+    "persist": int(os.getenv("PIPELINE_PERSIST_WORKERS", "1")),
+}
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+
 
 
 # Application definition